@@ -0,0 +1,255 @@
+#coding:utf-8
+"""
+Benchmark of the collector against the local mock DataCore REST server:
+objects/sec, records/sec, peak RSS and per-stage timings. With --format-only,
+only the formatting and encoding of the records are measured, on synthetic
+perf of the mock inventory (ex: --virtualdisks 50000).
+"""
+import sys
+import os
+import argparse
+import importlib
+import json
+import resource
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+
+BENCH_INI = """[SERVERS]
+rest_server = 127.0.0.1:{port}
+datacore_server = bench
+
+[CREDENTIALS]
+user = bench
+passwd = bench
+
+[LOGGING]
+log = no
+logfile = ./datacore_get_perf.log
+
+[RESOURCES]
+servers = yes
+pools = yes
+virtualdisks = yes
+physicaldisks = yes
+ports = yes
+hosts = yes
+servergroups = yes
+
+[PERF]
+executor = {executor}
+max_workers = {workers}
+batch_url = {batch_url}
+
+[INVENTORY]
+cache_file =
+
+[OUTPUT]
+file = {output}
+encoder = {encoder}
+"""
+
+
+def start_mock(args):
+    """
+    Start the mock REST server in its own process and wait for it to listen
+    """
+    mock = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datacore_mock_server.py")
+    cmd = [sys.executable, mock, "--port", str(args.port),
+           "--servers", str(args.servers), "--hosts", str(args.hosts),
+           "--pools", str(args.pools), "--virtualdisks", str(args.virtualdisks),
+           "--physicaldisks", str(args.physicaldisks), "--ports", str(args.ports),
+           "--counters", str(args.counters), "--latency", str(args.latency)]
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Mock server did not start on port {}".format(args.port))
+
+
+def make_collector(workdir, args):
+    """
+    Build the collector configured for the mock server. The cache and output
+    paths of its config are relative to the work directory.
+    """
+    ini = os.path.join(workdir, "datacore_get_perf.ini")
+    with open(ini, "w") as f:
+        f.write(BENCH_INI.format(port=args.port, executor=args.executor, workers=args.workers,
+                                 batch_url="performancebytype/{resource}" if args.batch else "",
+                                 output=os.path.join(workdir, "bench.json"),
+                                 encoder=args.encoder))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    dcs = importlib.import_module("datacore_get_perf")
+    return dcs, dcs.DataCoreCollector(ini)
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process, in MiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024.0 / (1024.0 if sys.platform == "darwin" else 1.0)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(dcs, collector, rounds, output):
+    """
+    Run the collection stage by stage, then pipelined, rounds times
+    """
+    target = collector.targets[0]
+    timings = {"inventory": [], "perf": [], "format": [], "write": [], "cycle": []}
+    counts = {}
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            objects = dcs.dcs_filter_objects(target, dcs.dcs_get_inventory(target, refresh=True))
+            timings["inventory"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            datas = list(dcs.dcs_get_perf(target, objects))
+            timings["perf"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            records = list(dcs.dcs_json_lines(target, datas))
+            timings["format"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            dcs.dcs_write_json_lines(iter(records), output)
+            timings["write"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            collector.collect()
+            timings["cycle"].append(time.perf_counter() - start)
+
+            counts = {"objects": len(datas), "records": len(records),
+                      "bytes": os.path.getsize(output)}
+    finally:
+        collector.close()
+
+    result = dict(counts)
+    result["stages"] = dict((stage, median(values)) for stage, values in timings.items())
+    result["objects_per_sec"] = counts["objects"] / result["stages"]["perf"]
+    result["records_per_sec"] = counts["records"] / result["stages"]["format"]
+    result["cycle_objects_per_sec"] = counts["objects"] / result["stages"]["cycle"]
+    result["cycle_records_per_sec"] = counts["records"] / result["stages"]["cycle"]
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_format(dcs, collector, rounds):
+    """
+    Format, then format and encode, the records of the inventory with
+    synthetic perf, rounds times, without perf requests. Records are streamed
+    as in a collection. Return the first (cold) round, then the median of
+    the next ones.
+    """
+    mock = importlib.import_module("datacore_mock_server")
+    target = collector.targets[0]
+    encode = dcs.dcs_record_encoder(collector.settings)
+    try:
+        objects = dcs.dcs_filter_objects(target, dcs.dcs_get_inventory(target, refresh=True))
+    finally:
+        collector.close()
+    timings = {"format": [], "encode": []}
+    for _ in range(rounds):
+        datas = [dict(o, Performances=mock.make_performance(o["Id"])) for o in objects]
+
+        start = time.perf_counter()
+        records = 0
+        for record in dcs.dcs_json_lines(target, datas):
+            records += 1
+        timings["format"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        nbytes = 0
+        for record in dcs.dcs_json_lines(target, datas):
+            nbytes += len(encode(record))
+        timings["encode"].append(time.perf_counter() - start - timings["format"][-1])
+
+    result = {"objects": len(objects), "records": records, "bytes": nbytes}
+    result["cold"] = dict((stage, values[0]) for stage, values in timings.items())
+    result["warm"] = dict((stage, median(values[1:])) for stage, values in timings.items())
+    for run in ("cold", "warm"):
+        result[run]["records_per_sec"] = records / (result[run]["format"] + result[run]["encode"])
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def report_format(result):
+    print("Objects            : {}".format(result["objects"]))
+    print("Records            : {}".format(result["records"]))
+    print("Output size        : {:.1f} MiB".format(result["bytes"] / 1048576.0))
+    for run in ("cold", "warm"):
+        print("{:<19}: format {:8.3f} s, encode {:8.3f} s, {:10.0f} records/s".format(
+            run.capitalize() + " round", result[run]["format"], result[run]["encode"], result[run]["records_per_sec"]))
+    print("Peak RSS           : {:10.1f} MiB".format(result["peak_rss_mb"]))
+
+
+def report(result):
+    print("Objects            : {}".format(result["objects"]))
+    print("Records            : {}".format(result["records"]))
+    print("Output size        : {:.1f} MiB".format(result["bytes"] / 1048576.0))
+    for stage in ("inventory", "perf", "format", "write", "cycle"):
+        print("{:<19}: {:8.3f} s".format(stage.capitalize(), result["stages"][stage]))
+    print("Perf fetch         : {:10.0f} objects/s".format(result["objects_per_sec"]))
+    print("Formatting         : {:10.0f} records/s".format(result["records_per_sec"]))
+    print("Pipelined cycle    : {:10.0f} objects/s, {:.0f} records/s".format(
+        result["cycle_objects_per_sec"], result["cycle_records_per_sec"]))
+    print("Peak RSS           : {:10.1f} MiB".format(result["peak_rss_mb"]))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the collector against the mock DataCore REST server")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--servers", type=int, default=2)
+    parser.add_argument("--hosts", type=int, default=50)
+    parser.add_argument("--pools", type=int, default=8)
+    parser.add_argument("--virtualdisks", type=int, default=2000)
+    parser.add_argument("--physicaldisks", type=int, default=200)
+    parser.add_argument("--ports", type=int, default=32)
+    parser.add_argument("--counters", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added by the mock to every request")
+    parser.add_argument("--executor", default="thread", choices=["thread", "process"])
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--batch", action="store_true", help="use /performancebytype batched requests")
+    parser.add_argument("--encoder", default="auto")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--format-only", action="store_true",
+                        help="only measure formatting and encoding, on synthetic perf")
+    parser.add_argument("--json", action="store_true", help="print the result as json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="datacore_bench_")
+    mock = start_mock(args)
+    try:
+        dcs, collector = make_collector(workdir, args)
+        if args.format_only:
+            result = run_format(dcs, collector, max(2, args.rounds))
+        else:
+            result = run(dcs, collector, args.rounds, os.path.join(workdir, "bench.json"))
+    finally:
+        mock.terminate()
+        mock.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    elif args.format_only:
+        report_format(result)
+    else:
+        report(result)
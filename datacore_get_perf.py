@@ -1,67 +1,190 @@
 #coding:utf-8
 """
 Module for using DataCore REST API
+
+The collection is driven by a DataCoreCollector built from a config
+(configparser, ini path or dict). Importing the module has no side effect:
+requests and the optional modules (orjson, ujson, zstandard, pyarrow) are
+imported on first use.
 """
 from __future__ import unicode_literals
 import sys
+import os
+import time
+import json
+import logging
+import configparser
+import importlib
+import signal
+import threading
+import argparse
+import re
+import fnmatch
+import queue
+import bisect
+import itertools
+import socket
+import random
+import io
+import hashlib
+import glob
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+# Peak memory of the collector, not available on Windows
+try:
+    import resource as rusage
+except ImportError:
+    rusage = None
+
+logger = logging.getLogger(__name__)
 
 def msg_error_import(module_name):
     print("Need '{}' module, you have to install it".format(module_name))
     print("Run 'pip install {}'".format(module_name))
     sys.exit(1)
 
-try:
-    import logging
-except:
-    msg_error_import("logging")
-try:
-    import configparser
-except:
-    msg_error_import("configparser")
-try:
-    import requests
-except:
-    msg_error_import("requests")
-try:
-    import json
-except:
-    msg_error_import("json")
-try:
-    from concurrent.futures import ThreadPoolExecutor
-except:
-    msg_error_import("futures")
-try:
-    from concurrent.futures import ProcessPoolExecutor
-except:
-    msg_error_import("concurrent")
-try:
-    import time
-except:
-    msg_error_import("time")
+_dcs_modules = {}
 
+def _dcs_module(name):
+    """
+    Import a module on first use, None when it is not installed
+    """
+    try:
+        return _dcs_modules[name]
+    except KeyError:
+        pass
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        module = None
+    _dcs_modules[name] = module
+    return module
 
 
-# Read config file
-config = configparser.ConfigParser()
-try:
-    config.read('./datacore_get_perf.ini')
-except:
-    print("Config file (datacore_get_perf.ini) not found")
-    sys.exit(1)
+def dcs_read_config(config):
+    """
+    Get a ConfigParser from a ConfigParser, the path of an ini file or a dict
+    of sections
+    """
+    if isinstance(config, configparser.ConfigParser):
+        return config
+    parser = configparser.ConfigParser()
+    if isinstance(config, dict):
+        parser.read_dict(config)
+    elif not parser.read(config):
+        raise DcsError("Config file ({}) not found".format(config))
+    return parser
+
+def dcs_setup_logging(config):
+    """
+    Enable logging as [LOGGING] says
+    """
+    if config.getboolean('LOGGING', 'log', fallback=False):
+        logging.basicConfig(filename=config['LOGGING']['logfile'],
+                            format='%(asctime)s - %(message)s',
+                            level=logging.INFO)
+    else:
+        logging.basicConfig(format='%(asctime)s - %(message)s')
+
+def dcs_settings(config):
+    """
+    Read the collector settings from a config, with the resource specs,
+    filters and emitters precompiled
+    """
+    settings = {
+        # Perf fetch engine settings
+        "perf_executor": config.get('PERF', 'executor', fallback='thread'),
+        "perf_max_workers": config.getint('PERF', 'max_workers', fallback=16),
+        "perf_batch_url": config.get('PERF', 'batch_url', fallback=''),
+        "perf_batch_size": config.getint('PERF', 'batch_size', fallback=100),
+        "perf_batch_id_key": config.get('PERF', 'batch_id_key', fallback='ObjectId'),
+        "perf_connect_timeout": config.getfloat('PERF', 'connect_timeout', fallback=5),
+        "perf_read_timeout": config.getfloat('PERF', 'read_timeout', fallback=30),
+        "perf_retries": config.getint('PERF', 'retries', fallback=2),
+        "perf_backoff": config.getfloat('PERF', 'backoff', fallback=0.5),
+        "perf_deadline": config.getfloat('PERF', 'deadline', fallback=0),
+        "perf_adaptive": config.getboolean('PERF', 'adaptive', fallback=True),
+        "perf_min_workers": config.getint('PERF', 'min_workers', fallback=2),
+        "perf_latency_tolerance": config.getfloat('PERF', 'latency_tolerance', fallback=2),
+
+        # Daemon mode settings
+        "daemon_mode": config.getboolean('DAEMON', 'daemon', fallback=False),
+        "daemon_interval": config.getfloat('DAEMON', 'interval', fallback=60),
+
+        # Inventory cache settings
+        "inventory_ttl": config.getfloat('INVENTORY', 'ttl', fallback=3600),
+        "inventory_cache_file": config.get('INVENTORY', 'cache_file', fallback=''),
+        "inventory_incremental": config.getboolean('INVENTORY', 'incremental', fallback=True),
+        "inventory_events": config.getboolean('INVENTORY', 'events', fallback=True),
+        "inventory_states_ttl": config.getfloat('INVENTORY', 'states_ttl', fallback=None),
 
-# Enable logging
-if config['LOGGING'].getboolean('log'):
-    logging.basicConfig(filename=config['LOGGING']['logfile'],
-                        format='%(asctime)s - %(message)s',
-                        level=logging.INFO)
-else:
-    logging.basicConfig(format='%(asctime)s - %(message)s')
+        # Output settings
+        "output_file": config.get('OUTPUT', 'file', fallback='datacore_perf_%Y%m%d-%H%M%S.json'),
+        "output_encoder": config.get('OUTPUT', 'encoder', fallback='auto'),
+        "output_sink": config.get('OUTPUT', 'sink', fallback='file'),
+        "output_format": config.get('OUTPUT', 'format', fallback='json'),
+        "output_compress": config.get('OUTPUT', 'compress', fallback='none'),
+        "output_rotate_size": config.getfloat('OUTPUT', 'rotate_size', fallback=100),
+        "output_rotate_keep": config.getint('OUTPUT', 'rotate_keep', fallback=0),
+        "output_url": config.get('OUTPUT', 'url', fallback=''),
+        "output_address": config.get('OUTPUT', 'address', fallback=''),
+        "output_batch_size": config.getint('OUTPUT', 'batch_size', fallback=5000),
+        "output_graphite_prefix": config.get('OUTPUT', 'graphite_prefix', fallback='datacore'),
+        "output_layout": config.get('OUTPUT', 'layout', fallback='long'),
+
+        # Delta/rate settings
+        "rates_enabled": config.getboolean('RATES', 'enabled', fallback=False),
+        "rates_counters": [c.strip() for c in config.get('RATES', 'counters', fallback='Total*').split(',') if c.strip()],
+        "rates_state_file": config.get('RATES', 'state_file', fallback=''),
+        "rates_max_age": config.getfloat('RATES', 'max_age', fallback=86400),
+        "rate_counters": {},
+
+        # Self-metrics settings
+        "stats_enabled": config.getboolean('STATS', 'enabled', fallback=False),
+        "stats_file": config.get('STATS', 'file', fallback=''),
+
+        # Sharding settings
+        "shard_index": config.getint('SHARDING', 'index', fallback=0),
+        "shard_count": config.getint('SHARDING', 'count', fallback=1),
+    }
+    if settings["shard_count"] < 1 or not 0 <= settings["shard_index"] < settings["shard_count"]:
+        raise DcsError("[SHARDING] index must be between 0 and count - 1, count at least 1")
+    if settings["shard_count"] > 1:
+        # Collectors of several shards may share a directory
+        shard = "shard{}".format(settings["shard_index"])
+        for key in ("output_file", "stats_file"):
+            if settings[key] != "-":
+                settings[key] = _dcs_target_file(settings[key], shard)
+    if settings["output_layout"] == "wide" and settings["output_format"] in ("influx", "graphite"):
+        logger.warning("The {} format has one value per line, using the long layout".format(settings["output_format"]))
+        settings["output_layout"] = "long"
+
+    # Per resource inventory TTL, ex: virtualdisks_ttl
+    settings["inventory_ttls"] = {}
+    if config.has_section('INVENTORY'):
+        for option in config.options('INVENTORY'):
+            if option.endswith('_ttl') and option != 'states_ttl':
+                settings["inventory_ttls"][option[:-len('_ttl')]] = config.getfloat('INVENTORY', option)
+    if config.has_section('RESOURCES'):
+        settings["resources"] = [r for r in config['RESOURCES'] if config['RESOURCES'].getboolean(r)]
+    else:
+        settings["resources"] = []
+
+    specs = settings["specs"] = dcs_load_resource_specs(config)
+    # Resources whose lists carry states, refetched after [INVENTORY] states_ttl
+    settings["state_resources"] = set(name for name, spec in specs.items() if spec.get("states") or spec.get("extra"))
+    settings["hash_paths"] = dict((name, dcs_hash_paths(spec)) for name, spec in specs.items())
+    rules = dcs_load_filter_rules(config, specs)
+    settings["object_filters"] = dict((name, dcs_make_object_filter(spec, name, rules)) for name, spec in specs.items())
+    # Only the json module encodes records faster from their serialized metadata
+    prefix = (settings["output_format"] == "json" and settings["output_layout"] == "long"
+              and dcs_json_encoder_name(settings["output_encoder"]) == "json")
+    settings["emitters"] = dict((name, dcs_make_emitter(spec, dcs_make_counter_filter(name, rules),
+                                                        settings["output_layout"] == "wide", settings["rates_enabled"],
+                                                        prefix))
+                                for name, spec in specs.items())
+    return settings
 
-# Construct rest url and headers
-url = "http://{}/RestService/rest.svc/1.0".format(config['SERVERS']['rest_server'])
-headers = {'ServerHost': config['SERVERS']['datacore_server'],
-           'Authorization': 'Basic {} {}'.format(config['CREDENTIALS']['user'],
-                                                 config['CREDENTIALS']['passwd'])}
 
 
 
@@ -70,8 +193,6 @@ headers = {'ServerHost': config['SERVERS']['datacore_server'],
 
 dcs_b2g = lambda value:value/1024/1024/1024 # Convert Bytes to GigaBytes
 
-#dcs_request_perf = lambda value:requests.get('{}/performance/{}'.format(url,value), headers=headers) # request perf from dcs_object Id
-
 
 # fuctions
 
@@ -100,451 +221,2245 @@ def dcs_monitorid_to_str(i):
         return "Undefined"
 
 
+class DcsError(Exception):
+    """
+    A DataCore REST request that failed (connection, timeout, REST ErrorCode)
+    """
+
+
+# Upper bounds (seconds) of the HTTP latency histogram buckets
+DCS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def dcs_new_stats():
+    """
+    Empty self-metrics of one collection of a target
+    """
+    return {"stages": {}, "http": {}, "objects": 0, "requests": 0, "saved": 0,
+            "errors": 0, "retries": 0, "bytes": 0, "records": 0, "failed": 0, "filtered": 0,
+            "inventory_errors": {}, "concurrency": 0, "backoffs": 0, "inventory_objects": 0}
+
+def dcs_observe_call(stats, call, resource, observed):
+    """
+    Account one HTTP call: observed is (latency, bytes received, ok,
+    retries, error)
+    """
+    latency, nbytes, ok, retries, error = observed
+    http = stats["http"].get((call, resource))
+    if http is None:
+        http = stats["http"][(call, resource)] = {
+            "count": 0, "errors": 0, "retries": 0, "bytes": 0, "seconds": 0.0,
+            "buckets": [0] * (len(DCS_LATENCY_BUCKETS) + 1)}
+    http["count"] += 1
+    http["retries"] += retries
+    stats["retries"] += retries
+    http["bytes"] += nbytes
+    http["seconds"] += latency
+    http["buckets"][bisect.bisect_left(DCS_LATENCY_BUCKETS, latency)] += 1
+    stats["bytes"] += nbytes
+    if not ok:
+        http["errors"] += 1
+        stats["errors"] += 1
+
+
+def _dcs_target_file(filename, name):
+    """
+    Name of a per-target state file: the target name is added before the
+    extension when several targets are collected
+    """
+    if not filename or not name:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return "{}_{}{}".format(root, name, ext)
+
+def dcs_target(settings, name, rest_server, datacore_server, user, passwd, max_workers, tag=False):
+    """
+    Build a DataCore server group to collect and its collection state.
+    Records of a tagged target get a "target" field.
+    """
+    # Collectors of several shards may share a directory
+    shard = "shard{}".format(settings["shard_index"]) if settings["shard_count"] > 1 else None
+    return {
+        "name": name,
+        "tag": tag,
+        "settings": settings,
+        "rest_server": rest_server,
+        # What the perf workers need to connect (picklable)
+        "conn": {
+            "name": name,
+            "url": "http://{}/RestService/rest.svc/1.0".format(rest_server),
+            "headers": {'ServerHost': datacore_server,
+                        'Authorization': 'Basic {} {}'.format(user, passwd)},
+            "max_workers": max_workers,
+            "timeout": (settings["perf_connect_timeout"], settings["perf_read_timeout"]),
+            "retries": settings["perf_retries"],
+            "backoff": settings["perf_backoff"],
+            "batch_url": settings["perf_batch_url"],
+            "batch_id_key": settings["perf_batch_id_key"],
+        },
+        "max_workers": max_workers,
+        "concurrency": dcs_new_concurrency(settings, max_workers),
+        "executor": None,
+        "inventory": None,
+        "inventory_cache_file": _dcs_target_file(_dcs_target_file(settings["inventory_cache_file"], name if tag else None), shard),
+        "inventory_events": [],
+        "inventory_fetched": set(),
+        "inventory_invalidated": set(),
+        "index": {},
+        "meta_cache": {},
+        "unresolved": {},
+        "reported": set(),
+        "batch_unsupported": set(),
+        "stats": dcs_new_stats(),
+        "samples": None,
+        "rates_state_file": _dcs_target_file(_dcs_target_file(settings["rates_state_file"], name if tag else None), shard),
+    }
+
+def dcs_targets(config, settings):
+    """
+    Get the DataCore server groups to collect: every [TARGET:<name>] section,
+    or [SERVERS] and [CREDENTIALS] when there is none
+    """
+    perf_max_workers = settings["perf_max_workers"]
+    sections = [s for s in config.sections() if s.startswith("TARGET:")]
+    if not sections:
+        return [dcs_target(settings, "default",
+                           config['SERVERS']['rest_server'],
+                           config['SERVERS']['datacore_server'],
+                           config['CREDENTIALS']['user'],
+                           config['CREDENTIALS']['passwd'],
+                           perf_max_workers)]
+    return [dcs_target(settings, section[len("TARGET:"):],
+                       config[section]['rest_server'],
+                       config[section]['datacore_server'],
+                       config[section]['user'],
+                       config[section]['passwd'],
+                       config.getint(section, 'max_workers', fallback=perf_max_workers),
+                       tag=True)
+            for section in sections]
+
+
+_dcs_sessions = {}
+_dcs_sessions_pid = None
+_dcs_sessions_lock = threading.Lock()
+
+def dcs_session(conn):
+    """
+    Return the HTTP session of a target shared by all requests of this process.
+    Connections are kept alive and pooled up to the target max_workers.
+    """
+    global _dcs_sessions_pid
+    with _dcs_sessions_lock:
+        # A forked worker must not reuse the sockets of its parent
+        if _dcs_sessions_pid != os.getpid():
+            _dcs_sessions.clear()
+            _dcs_sessions_pid = os.getpid()
+        session = _dcs_sessions.get(_dcs_session_key(conn))
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.headers.update(conn["headers"])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=conn["max_workers"])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _dcs_sessions[_dcs_session_key(conn)] = session
+        return session
+
+def _dcs_session_key(conn):
+    # Several collectors of one process may use the same target name
+    return (conn["name"], conn["url"], tuple(sorted(conn["headers"].items())))
+
+def _dcs_http_get(conn, path, deadline=None):
+    """
+    GET a path of the REST service. Connection errors, timeouts and HTTP
+    5xx/429 are retried after a jittered exponential backoff, no later than
+    the deadline (time.monotonic()). Return the response (None when no
+    attempt got one) and what was observed: (latency, bytes received, ok,
+    retries, error), error being None on success (HTTP 200).
+    """
+    import requests
+    session = dcs_session(conn)
+    url = '{}/{}'.format(conn["url"], path)
+    start = time.perf_counter()
+    retries = 0
+    while True:
+        try:
+            res = session.get(url, timeout=conn["timeout"])
+        except requests.RequestException as e:
+            res = None
+            error = "{}: {}".format(type(e).__name__, e)
+        else:
+            if res.status_code < 500 and res.status_code != 429:
+                error = None
+                break
+            error = "HTTP {}".format(res.status_code)
+        if retries >= conn["retries"]:
+            break
+        delay = conn["backoff"] * 2 ** retries * random.uniform(0.5, 1.5)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            break
+        time.sleep(delay)
+        retries += 1
+    nbytes = len(res.content) if res is not None else 0
+    ok = res is not None and res.status_code == 200
+    if error is None and not ok:
+        error = "HTTP {}".format(res.status_code)
+    return res, (time.perf_counter() - start, nbytes, ok, retries, error)
+
+
+def dcs_executor(target):
+    """
+    Return the executor running the perf requests of a target, created on
+    first use and kept for the following collections.
+    """
+    if target["executor"] is None:
+        if target["settings"]["perf_executor"] == "process":
+            from concurrent.futures import ProcessPoolExecutor
+            target["executor"] = ProcessPoolExecutor(max_workers=target["max_workers"])
+        else:
+            target["executor"] = ThreadPoolExecutor(max_workers=target["max_workers"])
+    return target["executor"]
+
+def dcs_shutdown(targets):
+    """
+    Release the executors and the HTTP sessions of targets
+    """
+    for target in targets:
+        if target["executor"] is not None:
+            target["executor"].shutdown()
+            target["executor"] = None
+        with _dcs_sessions_lock:
+            session = _dcs_sessions.pop(_dcs_session_key(target["conn"]), None)
+        if session is not None:
+            session.close()
+
+
+# Perf concurrency control: multiplicative decrease factor, smoothing of the
+# recent latency, upward drift of the baseline latency (so that it follows a
+# lasting slowdown) and samples before the latency is trusted
+DCS_CONCURRENCY_DECREASE = 0.75
+DCS_LATENCY_SMOOTHING = 0.2
+DCS_LATENCY_DRIFT = 0.001
+DCS_LATENCY_WARMUP = 10
+
+def dcs_new_concurrency(settings, max_workers):
+    """
+    AIMD limit of the concurrent perf requests of a target, between [PERF]
+    min_workers and max_workers and kept across collections. None when
+    [PERF] adaptive is off: every request is queued to the executor at once.
+    """
+    if not settings["perf_adaptive"]:
+        return None
+    floor = max(1, min(settings["perf_min_workers"], max_workers))
+    return {"limit": float(floor), "floor": floor, "ceiling": max_workers,
+            "slow_start": True, "since_decrease": 0, "latency": {}}
+
+def dcs_concurrency_limit(target):
+    """
+    Number of perf requests a target may have in flight, None for no limit
+    """
+    concurrency = target["concurrency"]
+    return None if concurrency is None else int(concurrency["limit"])
+
+def dcs_observe_concurrency(target, resource, observed, batch=False):
+    """
+    Adapt the perf concurrency of a target to one perf call. The limit grows
+    while the latency stays flat (doubling until the first backoff, then by
+    one per window of requests) and is cut on errors, retries, or when the
+    recent latency of a resource exceeds latency_tolerance times its
+    baseline (lowest) latency. Batched calls only count by their errors, their latency
+    depends on the batch size.
+    """
+    concurrency = target["concurrency"]
+    if concurrency is None or observed is None:
+        return
+    latency, _, _, retries, error = observed
+    congested = error is not None or retries > 0
+    if not congested and not batch:
+        # [recent, baseline, samples]
+        averages = concurrency["latency"].get(resource)
+        if averages is None:
+            averages = concurrency["latency"][resource] = [latency, latency, 1]
+        else:
+            averages[0] += DCS_LATENCY_SMOOTHING * (latency - averages[0])
+            if latency < averages[1]:
+                averages[1] = latency
+            else:
+                averages[1] += DCS_LATENCY_DRIFT * (latency - averages[1])
+            averages[2] += 1
+        congested = (averages[2] >= DCS_LATENCY_WARMUP
+                     and averages[0] > averages[1] * target["settings"]["perf_latency_tolerance"])
+    concurrency["since_decrease"] += 1
+    if congested:
+        # The requests in flight saw the same load, cut once per window
+        if concurrency["since_decrease"] >= concurrency["limit"]:
+            concurrency["limit"] = max(concurrency["floor"], concurrency["limit"] * DCS_CONCURRENCY_DECREASE)
+            concurrency["slow_start"] = False
+            concurrency["since_decrease"] = 0
+            target["stats"]["backoffs"] += 1
+    elif concurrency["slow_start"]:
+        concurrency["limit"] = min(concurrency["ceiling"], concurrency["limit"] + 1)
+    else:
+        concurrency["limit"] = min(concurrency["ceiling"], concurrency["limit"] + 1.0 / concurrency["limit"])
+
 
-def dcs_get_object(dcs_object):
+def dcs_get_object(target, dcs_object, deadline=None, previous=None):
     """
-    Get DataCore Object (ex: servers, virtualdisks...)
+    Get DataCore Object (ex: servers, virtualdisks...), diffed against the
+    previous inventory entry (see dcs_diff_objects).
+    Raise DcsError when the REST server can't give it.
     """
-    logging.info('Begin to query the REST server at {}'.format(config['SERVERS']['rest_server']))
+    logger.info('Begin to query the REST server at {}'.format(target['rest_server']))
     
-    try:
-        r = requests.get('{}/{}'.format(url,dcs_object), headers=headers)
-    except:
-        logging.error("Something wrong during connection")
-        sys.exit(1)
+    r, observed = _dcs_http_get(target["conn"], dcs_object, deadline)
+    dcs_observe_call(target["stats"], "inventory", dcs_object, observed)
+    if observed[4] is not None:
+        logger.error("Something wrong during connection: {}".format(observed[4]))
+        raise DcsError(observed[4])
     else:
-        logging.info("Querying {}".format(dcs_object))
-        tmp = r.json()
-        result = []
+        logger.info("Querying {}".format(dcs_object))
+        try:
+            tmp = r.json()
+        except ValueError:
+            logger.error("Invalid json response for {}".format(dcs_object))
+            raise DcsError("Invalid json response")
         try:
             err = tmp["ErrorCode"]
         except:
-            logging.info("No Rest ErrorCode")
+            logger.info("No Rest ErrorCode")
         else:
-            logging.error(tmp["Message"])
-            sys.exit(1)
-        if dcs_object == "servers":
-            for item in tmp:
-                test = str(item["RegionNodeId"])
-                if str(test) != "None":
-                    item["dcs_resource"] = dcs_object
-                    result.append(item)
-                else:
-                    logging.info("Exception: Partner server: " +item["Caption"])
-            return result
-        elif dcs_object == "ports":      
-            for item in tmp:
-                if "Microsoft iSCSI" in item["Caption"] or "Loop" in item["Caption"]:
-                    test = 1
-                else:
-                    item["dcs_resource"] = dcs_object
-                    result.append(item)
-            return result
-        elif dcs_object == "physicaldisks":
-            for item in tmp:
-                if item["Type"] == 4:
-                    item["dcs_resource"] = dcs_object
-                    result.append(item)
-            return result
-        else:
-            for item in tmp:
+            logger.error(tmp["Message"])
+            raise DcsError(tmp["Message"])
+        return dcs_diff_objects(target, dcs_object, tmp, previous)
+
+
+def dcs_keep_object(dcs_object, item):
+    """
+    Tell if an object of a DataCore object list is reported
+    """
+    if dcs_object == "servers":
+        if str(item["RegionNodeId"]) != "None":
+            return True
+        logger.info("Exception: Partner server: " +item["Caption"])
+        return False
+    elif dcs_object == "ports":
+        return not ("Microsoft iSCSI" in item["Caption"] or "Loop" in item["Caption"])
+    elif dcs_object == "physicaldisks":
+        return item["Type"] == 4
+    return True
+
+# Fields dcs_keep_object decides on
+DCS_KEEP_FIELDS = ("RegionNodeId", "Caption", "Type")
+
+def dcs_hash_paths(spec):
+    """
+    Paths of the fields of a resource an object hash covers: its Id,
+    captions, metadata and filter, not its states
+    """
+    fields = ["Id", "ExtendedCaption", spec.get("instance", "ExtendedCaption")] + list(DCS_KEEP_FIELDS)
+    if spec.get("host"):
+        fields.append(spec["host"])
+    if spec.get("filter"):
+        fields.append(spec["filter"])
+    paths = []
+    for field in fields + spec.get("metadata", []):
+        path = _dcs_field(field)[1]
+        if path not in paths:
+            paths.append(path)
+    return tuple(paths)
+
+def dcs_object_hash(item, paths=None):
+    """
+    Stable hash of the fields at paths (see dcs_hash_paths) of a DataCore
+    object, of the whole object when None
+    """
+    if paths is not None:
+        item = [_dcs_get(item, path) for path in paths]
+    orjson = _dcs_module("orjson")
+    if orjson is not None:
+        data = orjson.dumps(item, option=orjson.OPT_SORT_KEYS)
+    else:
+        data = json.dumps(item, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def dcs_diff_objects(target, dcs_object, items, previous=None):
+    """
+    Filter a fetched DataCore object list. With the previous inventory entry
+    ([INVENTORY] incremental), objects whose metadata hash didn't change
+    are not processed again, only their states are updated, and the new and
+    changed ones are.
+    The added, removed and changed reported objects are appended to
+    target["inventory_events"].
+    Return the reported objects and the hash of every object (None when not
+    incremental).
+    """
+    incremental = target["settings"]["inventory_incremental"]
+    if not incremental:
+        previous = None
+    hashes = {} if incremental else None
+    known = previous.get("hashes") if previous is not None else None
+    kept = dict((o["Id"], o) for o in previous["objects"]) if known is not None else {}
+    events = target["inventory_events"]
+    paths = target["settings"]["hash_paths"].get(dcs_object)
+    result = []
+    for item in items:
+        if hashes is None:
+            if dcs_keep_object(dcs_object, item):
                 item["dcs_resource"] = dcs_object
                 result.append(item)
-            return result
+            continue
+        dcs_id = item.get("Id")
+        digest = hashes[dcs_id] = dcs_object_hash(item, paths)
+        if known is not None and known.get(dcs_id) == digest:
+            if kept.pop(dcs_id, None) is not None:
+                # Same metadata, fresh states
+                item["dcs_resource"] = dcs_object
+                result.append(item)
+            continue
+        if dcs_keep_object(dcs_object, item):
+            item["dcs_resource"] = dcs_object
+            result.append(item)
+            if known is not None:
+                events.append((dcs_object, "changed" if kept.pop(dcs_id, None) is not None else "added", item))
+    if known is not None:
+        # Left in kept: removed, or changed and no more reported
+        for dcs_id, item in kept.items():
+            events.append((dcs_object, "removed", item))
+    return result, hashes
+
+
+
+def dcs_request_perf(conn, dcs_id, deadline=None):
+    """
+    Get the Performances payload of one DataCore object Id, what was
+    observed of the call (None when it was not made) and the error. The
+    payload is None when the REST server doesn't know this Id anymore or
+    on error.
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        return None, None, "Collection deadline exceeded"
+    res, observed = _dcs_http_get(conn, 'performance/{}'.format(dcs_id), deadline)
+    logger.info("Querying perf for {}".format(dcs_id))
+    if observed[4] is not None:
+        return None, observed, observed[4]
+    try:
+        tmp = res.json()
+    except ValueError:
+        return None, observed, "Invalid json response"
+    if not isinstance(tmp, list):
+        return None, observed, "Unexpected response"
+    if not tmp:
+        # Unknown Id
+        return None, observed, None
+    return tmp[0], observed, None
+
+def dcs_request_perf_chunk(conn, dcs_ids, deadline=None):
+    """
+    Get the Performances payloads of several DataCore object Ids: a
+    (perf, observed, error) per Id. A failing Id doesn't stop the others.
+    """
+    return [dcs_request_perf(conn, dcs_id, deadline) for dcs_id in dcs_ids]
+
+def _dcs_batch_payload(entry, id_key):
+    """
+    Find the Performances payload in an entry of a batched perf response.
+    A flat entry is the payload, without its Id key.
+    """
+    if "CollectionTime" in entry:
+        return dict((k, v) for k, v in entry.items() if k != id_key)
+    for value in entry.values():
+        if isinstance(value, dict) and "CollectionTime" in value:
+            return value
+    return None
+
+def dcs_request_perf_batch(conn, dcs_resource, dcs_ids, deadline=None):
+    """
+    Get the Performances payloads of several DataCore object Ids in one
+    request ([PERF] batch_url). Return the payloads in the order of the Ids
+    (None for an Id missing from the response), or None when the request
+    failed or the REST server doesn't support it, what was observed of the
+    call and the error (None when not supported).
+    """
+    batch = conn["batch_url"].format(resource=dcs_resource, ids=",".join(dcs_ids))
+    logger.info("Querying batched perf for {} {}".format(len(dcs_ids), dcs_resource))
+    res, observed = _dcs_http_get(conn, batch, deadline)
+    if observed[4] is not None:
+        if res is not None and res.status_code in (400, 404, 405):
+            # Not a request this REST server knows
+            return None, observed, None
+        return None, observed, observed[4]
+    try:
+        tmp = res.json()
+    except ValueError:
+        return None, observed, None
+    if not isinstance(tmp, list):
+        return None, observed, None
+    perfs = {}
+    for entry in tmp:
+        if isinstance(entry, dict) and conn["batch_id_key"] in entry:
+            perfs[entry[conn["batch_id_key"]]] = _dcs_batch_payload(entry, conn["batch_id_key"])
+    if tmp and not perfs:
+        # Not the expected format, don't guess
+        return None, observed, None
+    return [perfs.get(dcs_id) for dcs_id in dcs_ids], observed, None
+
+
+def _dcs_submit_perf(target, dcs_objects, backlog, deadline=None):
+    """
+    Queue the per-object perf requests of DataCore objects
+    """
+    if target["settings"]["perf_executor"] == "process":
+        # Only Ids go to the workers and only Performances come back
+        chunksize = max(1, len(dcs_objects) // (target["max_workers"] * 4))
+    else:
+        chunksize = 1
+    for i in range(0, len(dcs_objects), chunksize):
+        chunk = dcs_objects[i:i+chunksize]
+        backlog.append((dcs_request_perf_chunk, (target["conn"], [o["Id"] for o in chunk], deadline), (None, chunk)))
+    target["stats"]["requests"] += len(dcs_objects)
 
+def _dcs_submit_perf_batches(target, dcs_objects, backlog, deadline=None):
+    """
+    Queue batched perf requests, per resource, for the resources where
+    batching was not found unsupported. Return the objects left to request
+    one by one.
+    """
+    by_resource = {}
+    for dcs_object in dcs_objects:
+        by_resource.setdefault(dcs_object["dcs_resource"], []).append(dcs_object)
+    # Without {ids} the request returns a whole resource, don't split it
+    settings = target["settings"]
+    size = settings["perf_batch_size"] if "{ids}" in settings["perf_batch_url"] else None
+    single = []
+    for resource, objects in by_resource.items():
+        if resource in target["batch_unsupported"]:
+            single += objects
+            continue
+        for i in range(0, len(objects), size or len(objects)):
+            batch = objects[i:i+size] if size else objects
+            backlog.append((dcs_request_perf_batch, (target["conn"], resource, [o["Id"] for o in batch], deadline), (resource, batch)))
+            target["stats"]["requests"] += 1
+    return single
 
+def _dcs_start_perf(target, backlog, pending):
+    """
+    Submit queued perf requests to the executor, up to the concurrency limit
+    of the target
+    """
+    executor = dcs_executor(target)
+    limit = dcs_concurrency_limit(target)
+    while backlog and (limit is None or len(pending) < limit):
+        function, args, key = backlog.popleft()
+        pending[executor.submit(function, *args)] = key
 
-def dcs_request_perf(dcs_object):
-    res = requests.get('{}/performance/{}'.format(url,dcs_object["Id"]), headers=headers)
-    logging.info("Querying perf for {}".format(dcs_object["Caption"]))
-    dcs_object["Performances"] = res.json()[0]
-    return dcs_object
+def _dcs_perf_error(target, dcs_object, error):
+    """
+    The DataCore object to report as an error record: no perf for it
+    """
+    logger.error("No perf for {} ({}): {}".format(dcs_object["Id"], dcs_object["Caption"], error))
+    target["stats"]["failed"] += 1
+    data = dict(dcs_object)
+    data["dcs_error"] = error
+    return data
 
-def dcs_get_perf(dcs_objects):
+def dcs_get_perf(target, dcs_objects, deadline=None):
     """
     Get DataCore Objects performances (ex: servers, virtualdisks...)
+    Objects are yielded in completion order, as soon as their perf arrived.
+    Objects whose perf failed, or was still pending at the deadline
+    (time.monotonic()), are yielded with their "dcs_error".
+    With [PERF] adaptive, requests are started as others complete, within
+    the concurrency limit of the target.
     """
 
-    logging.info('Begin to query the REST server for perf at {}'.format(config['SERVERS']['rest_server']))
+    logger.info('Begin to query the REST server for perf at {}'.format(target['rest_server']))
 
-    result = []
-    with ProcessPoolExecutor() as executor:
-        for  dcs_perf in zip(dcs_objects, executor.map(dcs_request_perf, dcs_objects)):
-            result.append(dcs_perf[1])
-    return result
+    stats = target["stats"]
+    stats["objects"] = len(dcs_objects)
+    start = time.perf_counter()
+    pending = {}
+    backlog = collections.deque()
+    if target["settings"]["perf_batch_url"]:
+        _dcs_submit_perf(target, _dcs_submit_perf_batches(target, dcs_objects, backlog, deadline), backlog, deadline)
+    else:
+        _dcs_submit_perf(target, dcs_objects, backlog, deadline)
+
+    try:
+        while pending or backlog:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            _dcs_start_perf(target, backlog, pending)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                resource, objects = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # A worker that died (process pool), not a REST failure
+                    for dcs_object in objects:
+                        yield _dcs_perf_error(target, dcs_object, "{}: {}".format(type(e).__name__, e))
+                    continue
+                if resource is not None:
+                    perfs, observed, error = result
+                    dcs_observe_call(stats, "perf", resource, observed)
+                    dcs_observe_concurrency(target, resource, observed, batch=True)
+                    if perfs is None:
+                        if error is None:
+                            logger.warning("Batched perf not supported for {}, falling back to per-object requests".format(resource))
+                            target["batch_unsupported"].add(resource)
+                        else:
+                            logger.warning("Batched perf of {} failed ({}), falling back to per-object requests".format(resource, error))
+                        perfs = [None] * len(objects)
+                    missing = [o for o, p in zip(objects, perfs) if p is None]
+                    if missing:
+                        _dcs_submit_perf(target, missing, backlog, deadline)
+                    results = [(p, None) for p in perfs if p is not None]
+                    objects = [o for o, p in zip(objects, perfs) if p is not None]
+                else:
+                    results = []
+                    for dcs_object, (perf, observed, error) in zip(objects, result):
+                        if observed is not None:
+                            dcs_observe_call(stats, "perf", dcs_object["dcs_resource"], observed)
+                            dcs_observe_concurrency(target, dcs_object["dcs_resource"], observed)
+                        results.append((perf, error))
+                # Refill before the consumer formats what arrived
+                _dcs_start_perf(target, backlog, pending)
+                for dcs_object, (perf, error) in zip(objects, results):
+                    if error is not None:
+                        yield _dcs_perf_error(target, dcs_object, error)
+                        continue
+                    if perf is None:
+                        logger.warning("No perf for unknown Id {} ({})".format(dcs_object["Id"], dcs_object["Caption"]))
+                        dcs_invalidate_inventory(target, dcs_object["dcs_resource"])
+                        continue
+                    # The inventory objects are cached, perf goes to a copy
+                    data = dict(dcs_object)
+                    data["Performances"] = perf
+                    yield data
+
+        if pending or backlog:
+            logger.error("Collection deadline exceeded with {} perf requests pending at {}".format(
+                len(pending) + len(backlog), target["rest_server"]))
+        for future, (resource, objects) in list(pending.items()):
+            future.cancel()
+            del pending[future]
+            for dcs_object in objects:
+                yield _dcs_perf_error(target, dcs_object, "Collection deadline exceeded")
+        while backlog:
+            for dcs_object in backlog.popleft()[2][1]:
+                yield _dcs_perf_error(target, dcs_object, "Collection deadline exceeded")
+    finally:
+        for future in pending:
+            future.cancel()
+        stats["concurrency"] = dcs_concurrency_limit(target) or target["max_workers"]
+        stats["saved"] = stats["objects"] - stats["requests"]
+        stats["stages"]["perf"] = time.perf_counter() - start
+        logger.info("Perf of {} objects in {} requests ({} round trips saved, {} failed, concurrency {}) at {}".format(
+            stats["objects"], stats["requests"], stats["saved"], stats["failed"], stats["concurrency"], target["rest_server"]))
 
 
-def dcs_caption_from_id(dcs_id,dcs_json_data):
+def dcs_build_index(dcs_lists):
+    """
+    Build the Id -> Caption index of the DataCore objects
+    """
+    index = {}
+    for dcs_list in dcs_lists:
+        for item in dcs_list:
+            index[item["Id"]] = str(item.get("Caption"))
+    return index
+
+def dcs_update_index(index, events):
+    """
+    Apply the inventory events (see dcs_diff_objects) to the Id -> Caption index
+    """
+    for dcs_object, event, item in events:
+        if event == "removed":
+            index.pop(item["Id"], None)
+        else:
+            index[item["Id"]] = str(item.get("Caption"))
+
+def dcs_caption_from_id(dcs_id,target):
     """
     Find Caption from an DataCore Id
-    """ 
-    for item in dcs_json_data:
-        if item["Id"] == dcs_id:
-            return str(item["Caption"])
+    """
+    try:
+        return target["index"][dcs_id]
+    except KeyError:
+        unresolved = target["unresolved"]
+        unresolved[dcs_id] = unresolved.get(dcs_id, 0) + 1
+        return "UNKNOWN"
 
+def dcs_report_unresolved_ids(target):
+    """
+    Log the Ids that could not be resolved to a caption during formatting.
+    Ids never seen before invalidate the servers and hosts inventory.
+    """
+    unresolved = target["unresolved"]
+    if not unresolved:
+        return
+    logger.warning("{} Id(s) not resolved to a caption ({} references) at {}: {}".format(
+        len(unresolved),
+        sum(unresolved.values()),
+        target["rest_server"],
+        ", ".join(unresolved)))
+    new_ids = set(unresolved) - target["reported"]
+    if new_ids:
+        target["reported"].update(new_ids)
+        dcs_invalidate_inventory(target, "servers")
+        dcs_invalidate_inventory(target, "hosts")
+    unresolved.clear()
 
 
 
 
-def put_in_json_line(datas):
+class DcsRecord(dict):
+    """
+    Output record built from the cached metadata of a DataCore object, the
+    cache entry is kept for the encoders reusing its serialized form
+    """
+    __slots__ = ("cached",)
 
-    result = []
+def dcs_record(meta, key, value, collection_time, cached=None):
+    """
+    Build one output record: object metadata, one value and its
+    CollectionTime. cached is the metadata cache entry meta comes from
+    (see dcs_object_meta).
+    """
+    if cached is None or key in meta:
+        record = dict(meta)
+    else:
+        record = DcsRecord(meta)
+        record.cached = cached
+    record[key] = value
+    record["CollectionTime"] = collection_time
+    return record
 
-    for data in datas:
-        if "servers" in data["dcs_resource"]:
-            line = '"instance":"{}","objecttype":"{}","host":"{}"{},{},{}'
-            objecttype = "DataCore Servers"
-            instance = str(data["ExtendedCaption"])
-            host = str(data["Caption"])
-            # Add specific info
-            add_info = ',"id":"{}"'.format(str(data["Id"]))
-            add_info += ',"OsVersion":"{}"'.format(str(data["OsVersion"]))
-            add_info += ',"ProductBuild":"{}"'.format(str(data["ProductBuild"]))
-            add_info += ',"ProductVersion":"{}"'.format(str(data["ProductVersion"]))
-            add_info += ',"ProductName":"{}"'.format(str(data["ProductName"]))
-            add_info += ',"ProductType":"{}"'.format(str(data["ProductType"]))
-            add_info += ',"Caption":"{}"'.format(str(data["Caption"]))
-            for k,v in data["Performances"].items():
-                if "CollectionTime" in k:
-                    continue
-                result.append(line.format(
-                    instance,
-                    objecttype,
-                    host,
-                    add_info,
-                    ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"State"', '"'+str(data["State"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-            ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"CacheState"', '"'+str(data["CacheState"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-            ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"PowerState"', '"'+str(data["PowerState"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-            ))
-        elif "pools" in data["dcs_resource"]:
-            line = '"instance":"{}","objecttype":"{}","host":{}{},{},{}'
-            objecttype = "DataCore Disk pools"
-            instance = str(data["ExtendedCaption"])
-            host = '"'+str(dcs_caption_from_id(data["ServerId"],dcs_servers))+'"'
-            # Add specific info
-            add_info = ',"id":"{}"'.format(str(data["Id"]))
-            add_info += ',"InSharedMode":"{}"'.format(str(data["InSharedMode"]))
-            add_info += ',"AutoTieringEnabled":"{}"'.format(str(data["AutoTieringEnabled"]))
-            add_info += ',"Caption":"{}"'.format(str(data["Caption"]))
+# Resource specs: how the objects of each resource are turned into records.
+# Fields are written "[key=][@]path[?][|default]": path is a dotted path in
+# the DataCore object, @ resolves an Id to its caption, ? skips the field
+# when the value is missing and |default replaces a missing value.
+DCS_RESOURCES = {
+    "servers": {
+        "objecttype": "DataCore Servers",
+        "instance": "ExtendedCaption",
+        "host": "Caption",
+        "metadata": ["id=Id", "OsVersion", "ProductBuild", "ProductVersion",
+                     "ProductName", "ProductType", "Caption"],
+        "states": ["State", "CacheState", "PowerState"],
+    },
+    "pools": {
+        "objecttype": "DataCore Disk pools",
+        "instance": "ExtendedCaption",
+        "host": "@ServerId",
+        "metadata": ["id=Id", "InSharedMode", "AutoTieringEnabled", "Caption"],
+        "states": ["PoolStatus", "TierReservedPct", "ChunkSize=ChunkSize.Value", "MaxTierNumber"],
+    },
+    "virtualdisks": {
+        "objecttype": "DataCore Virtual disks",
+        "instance": "ExtendedCaption",
+        "filter": "StorageProfileId",
+        "metadata": ["id=Id", "ScsiDeviceIdString", "Type", "FirstHost=@FirstHostId?",
+                     "SecondHost=@SecondHostId?", "Caption"],
+        "states": ["DiskStatus", "Size=Size.Value"],
+    },
+    "physicaldisks": {
+        "objecttype": "DataCore Physical disk",
+        "instance": "ExtendedCaption",
+        "host": "@HostId",
+        "metadata": ["id=Id", "Serial=InquiryData.Serial|UNKNOWN", "Type", "Caption"],
+        "states": ["DiskStatus"],
+    },
+    "ports": {
+        "objecttype": "DataCore SCSI ports",
+        "instance": "ExtendedCaption",
+        "host": "@HostId|NA",
+        "metadata": ["id=Id", "__type?", "PortType", "PortRole=ServerPortProperties.Role|N/A", "Caption"],
+        "states": [],
+    },
+    "hosts": {
+        "type_key": "objectname",
+        "objecttype": "DataCore Hosts",
+        "instance": "ExtendedCaption",
+        "host": "Caption",
+        "metadata": ["id=Id", "MpioCapable", "AluaSupport"],
+        "states": ["State"],
+    },
+    "servergroups": {
+        "type_key": "objectname",
+        "objecttype": "DataCore Server Groups",
+        "instance": "Alias",
+        "filter": "OurGroup",
+        "metadata": ["id=Id"],
+        "states": ["State", "StorageUsed=StorageUsed.Value", "NextExpirationDate?"],
+        "extra": "servergroup_licenses",
+    },
+}
+
+
+def dcs_load_resource_specs(config):
+    """
+    Get the resource specs, completed by the [RESOURCE:<name>] sections of the
+    config file. Lists (metadata, states) are comma separated.
+    """
+    specs = dict(DCS_RESOURCES)
+    for section in config.sections():
+        if not section.startswith("RESOURCE:"):
+            continue
+        spec = dict(config[section])
+        for key in ("metadata", "states"):
+            if key in spec:
+                spec[key] = [f.strip() for f in spec[key].split(",") if f.strip()]
+        specs[section[len("RESOURCE:"):]] = spec
+    return specs
+
+
+def _dcs_field(field):
+    """
+    Parse a spec field "[key=][@]path[?][|default]"
+    """
+    default = None
+    if "|" in field:
+        field, default = field.split("|", 1)
+    key, _, path = field.rpartition("=")
+    optional = path.endswith("?")
+    path = path.rstrip("?")
+    resolve = path.startswith("@")
+    path = path.lstrip("@")
+    return key or path, tuple(path.split(".")), resolve, optional, default
+
+def _dcs_get(data, path):
+    """
+    Get the value at a dotted path of a DataCore object, None when missing
+    """
+    for key in path:
+        try:
+            data = data[key]
+        except (KeyError, TypeError):
+            return None
+    return data
+
+def _dcs_field_values(target, data, fields):
+    """
+    Generate (key, value) of the spec fields of a DataCore object
+    """
+    for key, path, resolve, optional, default in fields:
+        value = _dcs_get(data, path)
+        if value is None:
+            if optional:
+                continue
+            if default is not None:
+                value = default
+        elif resolve:
+            value = dcs_caption_from_id(value, target)
+        yield key, value
+
+
+_dcs_date_re = re.compile(r"-?\d+")
+
+def dcs_collection_time_ms(collection_time):
+    """
+    Convert a DataCore "/Date(1520000000000+0100)/" to milliseconds since epoch
+    """
+    match = _dcs_date_re.search(str(collection_time))
+    return int(match.group()) if match else None
+
+def dcs_is_rate_counter(settings, name):
+    """
+    Tell if a perf counter is cumulative (matches [RATES] counters)
+    """
+    try:
+        return settings["rate_counters"][name]
+    except KeyError:
+        result = any(fnmatch.fnmatchcase(name, pattern) for pattern in settings["rates_counters"])
+        settings["rate_counters"][name] = result
+        return result
+
+def dcs_load_samples(target):
+    """
+    Load the last samples kept between one-shot runs
+    """
+    state_file = target["rates_state_file"]
+    if not state_file:
+        return {}
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        logger.info("No usable rates state in {}".format(state_file))
+        return {}
+
+def dcs_save_samples(target):
+    """
+    Write the last samples (atomically), forgetting the objects not seen
+    for more than max_age seconds
+    """
+    state_file = target["rates_state_file"]
+    samples = target["samples"]
+    if not state_file or samples is None:
+        return
+    oldest = (time.time() - target["settings"]["rates_max_age"]) * 1000
+    for dcs_id in [i for i, s in samples.items() if s[0] < oldest]:
+        del samples[dcs_id]
+    tmp = state_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(samples, f, separators=(",", ":"))
+    os.replace(tmp, state_file)
+
+def dcs_rates(target, dcs_id, perf):
+    """
+    Compute {counter: (delta, rate per second)} of the cumulative counters
+    against the previous sample of the same object, and keep this sample.
+    A counter lower than its previous value (reset) gets no rate.
+    """
+    if target["samples"] is None:
+        target["samples"] = dcs_load_samples(target)
+    samples = target["samples"]
+
+    now = dcs_collection_time_ms(perf.get("CollectionTime"))
+    if now is None:
+        return {}
+    settings = target["settings"]
+    values = dict((k, v) for k, v in perf.items()
+                  if dcs_is_rate_counter(settings, k) and isinstance(v, (int, float)) and not isinstance(v, bool))
+
+    rates = {}
+    previous = samples.get(dcs_id)
+    if previous is not None:
+        elapsed = (now - previous[0]) / 1000.0
+        if elapsed <= 0:
+            # Same sample as last time, keep the older one as reference
+            return {}
+        for k, v in values.items():
+            last = previous[1].get(k)
+            if last is None:
+                continue
+            if v < last:
+                logger.info("Counter reset of {} for {}".format(k, dcs_id))
+                continue
+            rates[k] = (v - last, (v - last) / elapsed)
+    samples[dcs_id] = [now, values]
+    return rates
+
+
+def dcs_servergroup_licenses(data, meta, collection_time):
+    """
+    Records of the license settings and product keys of a server group
+    """
+    for k,v in data["LicenseSettings"].items():
+        if isinstance(v, dict) and "Value" in v:
+            v = v["Value"]
+        yield dcs_record(meta, k, v, collection_time)
+
+    for productkey in data["ExistingProductKeys"]:
+        key_meta = dict(meta, LastFive=productkey["LastFive"])
+        for k,v in productkey.items():
+            if k == "LastFive":
+                continue
+            if isinstance(v, dict) and "Value" in v:
+                v = v["Value"]
+            yield dcs_record(key_meta, k, v, collection_time)
+
+DCS_EXTRA_RECORDS = {
+    "servergroup_licenses": dcs_servergroup_licenses,
+}
+
+
+def dcs_widen(records):
+    """
+    Merge consecutive records of the same metadata into one row: value
+    columns, Delta and Rate as <value>_delta and <value>_rate columns
+    """
+    row = None
+    tags = None
+    collection_time = None
+    for record in records:
+        record_tags, values, _ = _dcs_record_parts(record)
+        if row is None or record_tags != tags:
+            if row is not None:
+                row["CollectionTime"] = collection_time
+                yield row
+            tags = record_tags
+            row = dict(tags)
+            collection_time = record["CollectionTime"]
+        row.update(values)
+    if row is not None:
+        row["CollectionTime"] = collection_time
+        yield row
+
+def dcs_states_time(target, resource, collection_time):
+    """
+    CollectionTime of the states of an object: the perf one when its list
+    was fetched during this collection, the time the list was fetched when
+    it comes from the inventory cache
+    """
+    if resource in target["inventory_fetched"]:
+        return collection_time
+    entry = target["inventory"].get(resource) if target["inventory"] else None
+    if entry is None:
+        return collection_time
+    return "/Date({})/".format(int(entry["time"] * 1000))
+
+def dcs_object_meta(target, data, make_meta):
+    """
+    Get the metadata cache entry of a DataCore object: its metadata, as
+    make_meta(target, data) builds it, and the serialized forms of it the
+    encoders made. Entries are kept by Id until an inventory refresh
+    changes the object (see dcs_invalidate_meta).
+    """
+    cached = target["meta_cache"].get(data["Id"])
+    if cached is None:
+        meta = make_meta(target, data)
+        cached = {"meta": meta, "size": len(meta), "prefixes": {}}
+        # Records overwriting a metadata key can't reuse its serialized form
+        if not any(k in meta for k in ("CollectionTime", "Delta", "Rate")):
+            target["meta_cache"][data["Id"]] = cached
+    return cached
+
+def dcs_invalidate_meta(target, events):
+    """
+    Drop the cached metadata made stale by the inventory events (before they
+    are applied to the index): the changed objects, or all of them when an
+    Id they may resolve to a caption was added, removed or renamed
+    """
+    cache = target["meta_cache"]
+    index = target["index"]
+    for dcs_object, event, item in events:
+        if event == "removed" or index.get(item["Id"]) != str(item.get("Caption")):
+            cache.clear()
+            return
+        cache.pop(item["Id"], None)
+
+
+def dcs_make_emitter(spec, counters=None, wide=False, rates_enabled=False, prefix=False):
+    """
+    Precompile the record generator of one resource spec. counters tells
+    if a perf counter is written (all when None). wide makes one row per
+    object, the counters and states as columns. rates_enabled adds the
+    Delta and Rate of the cumulative counters. prefix makes records keeping
+    their metadata cache entry (see _dcs_prefix_encoder).
+    """
+    type_key = spec.get("type_key", "objecttype")
+    objecttype = spec["objecttype"]
+    instance = _dcs_field(spec.get("instance", "ExtendedCaption"))[1]
+    host = [("host",) + _dcs_field(spec["host"])[1:]] if spec.get("host") else []
+    metadata = host + [_dcs_field(f) for f in spec.get("metadata", [])]
+    states = [_dcs_field(f) for f in spec.get("states", [])]
+    extra = DCS_EXTRA_RECORDS[spec["extra"]] if spec.get("extra") else None
+
+    def make_meta(target, data):
+        meta = {"instance": _dcs_get(data, instance), type_key: objecttype}
+        if target["tag"]:
+            meta["target"] = target["name"]
+        meta.update(_dcs_field_values(target, data, metadata))
+        return meta
+
+    def emit(target, data):
+        cached = dcs_object_meta(target, data, make_meta)
+        meta = cached["meta"]
+        if not prefix:
+            cached = None
+        collection_time = data["Performances"]["CollectionTime"]
+        states_time = dcs_states_time(target, data["dcs_resource"], collection_time)
+        rates = dcs_rates(target, data["Id"], data["Performances"]) if rates_enabled else None
+        if wide:
+            row = dict(meta)
             for k,v in data["Performances"].items():
-                if "CollectionTime" in k:
+                if k == "CollectionTime":
                     continue
-                result.append(line.format(
-                    instance,
-                    objecttype,
-                    host,
-                    add_info,
-                    ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"PoolStatus"', '"'+str(data["PoolStatus"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-            ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"TierReservedPct"', '"'+str(data["TierReservedPct"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-            ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"ChunkSize"', '"'+str(data["ChunkSize"]["Value"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-            ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"MaxTierNumber"', '"'+str(data["MaxTierNumber"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-            ))
-        elif "virtualdisks" in data["dcs_resource"]:
-            if data["StorageProfileId"] != None:
-                line = '"instance":"{}","objecttype":"{}"{},{},{}'
-                objecttype = "DataCore Virtual disks"
-                instance = str(data["ExtendedCaption"])
-                # Add specific info
-                add_info = ',"id":"{}"'.format(str(data["Id"]))
-                add_info += ',"ScsiDeviceIdString":"{}"'.format(str(data["ScsiDeviceIdString"]))
-                add_info += ',"Type":"{}"'.format(str(data["Type"])) 
-                if data["FirstHostId"] != None:
-                    add_info += ',"FirstHost":"{}"'.format(str(dcs_caption_from_id(data["FirstHostId"],dcs_servers)))
-                if data["SecondHostId"] != None:
-                    add_info += ',"SecondHost":"{}"'.format(str(dcs_caption_from_id(data["SecondHostId"],dcs_servers)))
-                add_info += ',"Caption":"{}"'.format(str(data["Caption"]))
-                for k,v in data["Performances"].items():
-                    if "CollectionTime" in k:
-                        continue
-                    result.append(line.format(
-                        instance,
-                        objecttype,
-                        add_info,
-                        ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                        '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                    ))
-                result.append(line.format(
-                        instance,
-                        objecttype,
-                        add_info,
-                        ":".join(['"DiskStatus"', '"'+str(data["DiskStatus"])+'"']),
-                        '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                    ))
-                result.append(line.format(
-                        instance,
-                        objecttype,
-                        add_info,
-                        ":".join(['"Size"', '"'+str(data["Size"]["Value"])+'"']),
-                        '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                    ))
-        elif "physicaldisks" in data["dcs_resource"]:
-            line = '"instance":"{}","objecttype":"{}","host":{}{},{},{}'
-            objecttype = "DataCore Physical disk"
-            instance = str(data["ExtendedCaption"])
-            host = '"'+str(dcs_caption_from_id(data["HostId"],dcs_servers))+'"'
-            # Add specific info
-            add_info = ',"id":"{}"'.format(str(data["Id"]))
-            if data["InquiryData"]["Serial"] != None:
-                add_info += ',"Serial":"{}"'.format(str(data["InquiryData"]["Serial"]))
-            else:
-                add_info += ',"Serial":"UNKNOWN"'
-            add_info += ',"Type":"{}"'.format(data["Type"])
-            add_info += ',"Caption":"{}"'.format(data["Caption"])
-            for k,v in data["Performances"].items():
-                if "CollectionTime" in k:
+                if counters is not None and not counters(k):
                     continue
-                result.append(line.format(
-                    instance,
-                    objecttype,
-                    host,
-                    add_info,
-                    ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-            result.append(line.format(
-                    instance,
-                    objecttype,
-                    host,
-                    add_info,
-                    ":".join(['"DiskStatus"', '"'+str(data["DiskStatus"])+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-        elif "ports" in data["dcs_resource"]:
-            line = '"instance":"{}","objecttype":"{}","host":{}{},{},{}'
-            objecttype = "DataCore SCSI ports"
-            instance = str(data["ExtendedCaption"])
-            if data["HostId"] != None:
-                host = '"'+str(dcs_caption_from_id(data["HostId"],dcs_servers))+'"'
+                row[k] = v
+                if rates and k in rates:
+                    row[k + "_delta"], row[k + "_rate"] = rates[k]
+            row.update(_dcs_field_values(target, data, states))
+            row["CollectionTime"] = collection_time
+            if states_time != collection_time:
+                row["StatesCollectionTime"] = states_time
+            yield row
+            if extra is not None:
+                for row in dcs_widen(extra(data, meta, states_time)):
+                    yield row
+            return
+        for k,v in data["Performances"].items():
+            if k == "CollectionTime":
+                continue
+            if counters is not None and not counters(k):
+                continue
+            record = dcs_record(meta, k, v, collection_time, cached)
+            if rates and k in rates:
+                record["Delta"], record["Rate"] = rates[k]
+            yield record
+        for k,v in _dcs_field_values(target, data, states):
+            yield dcs_record(meta, k, v, states_time, cached)
+        if extra is not None:
+            for record in extra(data, meta, states_time):
+                yield record
+
+    return emit
+
+DCS_FILTER_OPTIONS = ("include_captions", "exclude_captions", "include_ids", "exclude_ids",
+                      "include_counters", "exclude_counters")
+
+def dcs_load_filter_rules(config, specs):
+    """
+    Parse the [FILTERS] options: comma separated rules, each limited to a
+    resource by a "resource:" prefix.
+    Return {option: {resource or None: [rules]}}.
+    """
+    result = {}
+    for option in DCS_FILTER_OPTIONS:
+        rules = result[option] = {}
+        for rule in config.get('FILTERS', option, fallback='').split(","):
+            rule = rule.strip()
+            if not rule:
+                continue
+            resource, sep, pattern = rule.partition(":")
+            # Ids may contain ":", only a resource name is a prefix
+            if not sep or resource not in specs:
+                resource, pattern = None, rule
+            rules.setdefault(resource, []).append(pattern)
+    return result
+
+def _dcs_globs(rules, resource):
+    """
+    Compile the glob rules applying to a resource into one match function,
+    None when there is none
+    """
+    patterns = rules.get(None, []) + rules.get(resource, [])
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns)).match
+
+def dcs_make_object_filter(spec, resource, rules):
+    """
+    Precompile the function telling if an object of a resource is collected:
+    the spec filter then the [FILTERS] caption and Id rules
+    """
+    keep = _dcs_field(spec["filter"])[1] if spec.get("filter") else None
+    include_captions = _dcs_globs(rules["include_captions"], resource)
+    exclude_captions = _dcs_globs(rules["exclude_captions"], resource)
+    include_ids = rules["include_ids"]
+    include_ids = set(include_ids.get(None, []) + include_ids.get(resource, []))
+    exclude_ids = rules["exclude_ids"]
+    exclude_ids = set(exclude_ids.get(None, []) + exclude_ids.get(resource, []))
+
+    def captions(item):
+        return [str(c) for c in (item.get("Caption"), item.get("ExtendedCaption")) if c is not None]
+
+    def accept(item):
+        if keep is not None and _dcs_get(item, keep) in (None, False):
+            return False
+        if include_captions is not None or include_ids:
+            if not (item["Id"] in include_ids
+                    or (include_captions is not None and any(include_captions(c) for c in captions(item)))):
+                return False
+        if item["Id"] in exclude_ids:
+            return False
+        if exclude_captions is not None and any(exclude_captions(c) for c in captions(item)):
+            return False
+        return True
+
+    return accept
+
+def dcs_make_counter_filter(resource, rules):
+    """
+    Precompile the function telling if a perf counter of a resource is
+    written ([FILTERS] counter rules), None when every counter is
+    """
+    include = _dcs_globs(rules["include_counters"], resource)
+    exclude = _dcs_globs(rules["exclude_counters"], resource)
+    if include is None and exclude is None:
+        return None
+    cache = {}
+
+    def accept(name):
+        try:
+            return cache[name]
+        except KeyError:
+            result = (include is None or include(name) is not None) and (exclude is None or exclude(name) is None)
+            cache[name] = result
+            return result
+
+    return accept
+
+
+def dcs_in_shard(settings, dcs_id):
+    """
+    Tell if a DataCore object Id belongs to the [SHARDING] index of this
+    collector. The hash is stable across processes and hosts, so that every
+    collector of a group splits the objects the same way.
+    """
+    if settings["shard_count"] == 1:
+        return True
+    digest = hashlib.blake2b(str(dcs_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % settings["shard_count"] == settings["shard_index"]
+
+def dcs_filter_objects(target, dcs_objects):
+    """
+    Keep the DataCore objects to collect the perf of ([FILTERS] and the spec
+    filters, then the [SHARDING] share of this collector), before any perf
+    request
+    """
+    settings = target["settings"]
+    result = []
+    for dcs_object in dcs_objects:
+        accept = settings["object_filters"].get(dcs_object["dcs_resource"])
+        if accept is None or accept(dcs_object):
+            result.append(dcs_object)
+    target["stats"]["filtered"] = len(dcs_objects) - len(result)
+    target["stats"]["inventory_objects"] = len(result)
+    if settings["shard_count"] > 1:
+        result = [o for o in result if dcs_in_shard(settings, o["Id"])]
+    return result
+
+
+def dcs_object_record(target, resource, data, key, value):
+    """
+    Record about a DataCore object itself (error, inventory event): its
+    instance, objecttype and Id, and one value
+    """
+    spec = target["settings"]["specs"].get(resource, {})
+    meta = {"instance": _dcs_get(data, _dcs_field(spec.get("instance", "ExtendedCaption"))[1]),
+            spec.get("type_key", "objecttype"): spec.get("objecttype", resource)}
+    if target["tag"]:
+        meta["target"] = target["name"]
+    meta["id"] = data["Id"]
+    return dcs_record(meta, key, value, "/Date({})/".format(int(time.time() * 1000)))
+
+def dcs_error_record(target, data):
+    """
+    Record of a DataCore object whose perf could not be collected
+    """
+    return dcs_object_record(target, data["dcs_resource"], data, "Error", data["dcs_error"])
+
+
+def dcs_json_lines(target, datas):
+    """
+    Generate the records of the DataCore objects performances
+    """
+    stats = target["stats"]
+    elapsed = 0.0
+    for data in datas:
+        try:
+            emit = target["settings"]["emitters"][data["dcs_resource"]]
+        except KeyError:
+            logger.error("This resource ({}) is not yet implemented".format(data["dcs_resource"]))
+            continue
+        start = time.perf_counter()
+        if "dcs_error" in data:
+            records = [dcs_error_record(target, data)]
+        else:
+            records = list(emit(target, data))
+        elapsed += time.perf_counter() - start
+        stats["records"] += len(records)
+        for record in records:
+            yield record
+    stats["stages"]["format"] = elapsed
+    dcs_report_unresolved_ids(target)
+
+
+def dcs_json_encoder_name(name):
+    """
+    Name of the json encoder used for an [OUTPUT] encoder: orjson then ujson
+    when installed, json otherwise
+    """
+    for module in ("orjson", "ujson"):
+        if name in ("auto", module) and _dcs_module(module) is not None:
+            return module
+    return "json"
+
+def dcs_json_encoder(name):
+    """
+    Return a function serializing a record to a json line (bytes).
+    orjson then ujson are used when installed, json otherwise.
+    """
+    used = dcs_json_encoder_name(name)
+    if used == "orjson":
+        orjson = _dcs_module("orjson")
+        return lambda record: orjson.dumps(record) + b"\n"
+    if used == "ujson":
+        ujson = _dcs_module("ujson")
+        return lambda record: ujson.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+    if name not in ("auto", "json"):
+        logger.warning("Json encoder {} not available, using json".format(name))
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    return _dcs_prefix_encoder("json", lambda value: encoder.encode(value).encode("utf-8"))
+
+def _dcs_prefix_encoder(name, dumps):
+    """
+    Json line encoder reusing the serialized metadata of the records built
+    from the metadata cache: only their values are encoded. Worth it for
+    the json module only, orjson encodes whole records faster.
+    """
+    keys = {}
+    last = [None, None]
+
+    def encode(record):
+        cached = getattr(record, "cached", None)
+        if cached is None:
+            return dumps(record) + b"\n"
+        prefix = cached["prefixes"].get(name)
+        if prefix is None:
+            # Without the closing brace
+            prefix = cached["prefixes"][name] = dumps(cached["meta"])[:-1]
+        line = [prefix]
+        for key, value in itertools.islice(record.items(), cached["size"], None):
+            encoded_key = keys.get(key)
+            if encoded_key is None:
+                encoded_key = keys[key] = b"," + dumps(key) + b":"
+            line.append(encoded_key)
+            if type(value) is int:
+                line.append(str(value).encode("ascii"))
+            elif value is last[0]:
+                # The CollectionTime of the records of an object
+                line.append(last[1])
             else:
-                host = "'NA'"
-            # Add specific info
-            add_info = ',"id":"{}"'.format(str(data["Id"]))
-            try:
-                if data["__type"] != None:
-                    add_info += ',"__type":"{}"'.format(str(data["__type"]))
-                    add_info += ',"Role":"{}"'.format(str(data["ServerPortProperties"]["Role"]))
-            except:
-                logging.info("No __type")
-                
-            add_info += ',"PortType":"{}"'.format(str(data["PortType"]))
-            
-            try:
-                add_info += ',"PortRole":"{}"'.format(str(data["ServerPortProperties"]["Role"]))
-            except:
-                add_info += ',"PortRole":"N/A"'
+                last[0] = value
+                last[1] = dumps(value)
+                line.append(last[1])
+        line.append(b"}\n")
+        return b"".join(line)
 
-            add_info = ',"Caption":"{}"'.format(str(data["Caption"]))
-            for k,v in data["Performances"].items():
-                if "CollectionTime" in k:
-                    continue
-                result.append(line.format(
-                    instance,
-                    objecttype,
-                    host,
-                    add_info,
-                    ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-        elif "hosts" in data["dcs_resource"]:
-            line = '"instance":"{}","objectname":"{}","host":"{}"{},{},{}'
-            objecttype = "DataCore Hosts"
-            instance = str(data["ExtendedCaption"])
-            host = str(data["Caption"])
-            # Add specific info
-            add_info = ',"id":"{}"'.format(str(data["Id"]))
-            add_info += ',"MpioCapable":"{}"'.format(str(data["MpioCapable"]))
-            add_info += ',"AluaSupport":"{}"'.format(str(data["AluaSupport"]))
-            for k,v in data["Performances"].items():
-                if "CollectionTime" in k:
-                    continue
-                result.append(line.format(
-                    instance,
-                    objecttype,
-                    host,
-                    add_info,
-                    ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                host,
-                add_info,
-                ":".join(['"State"', '"'+str(data["State"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-             ))
-        elif "servergroups" in data["dcs_resource"]:
-            if data["OurGroup"] != True:
+    return encode
+
+def _dcs_record_parts(record):
+    """
+    Split a record into its metadata, its value(s) and its CollectionTime in
+    milliseconds. The value is the field set just before CollectionTime
+    (see dcs_record), Delta and Rate come after it.
+    """
+    keys = list(record)
+    try:
+        i = keys.index("CollectionTime")
+    except ValueError:
+        return None, None, None
+    if i == 0:
+        return None, None, None
+    tags = [(k, record[k]) for k in keys[:i - 1]]
+    values = [(keys[i - 1], record[keys[i - 1]])]
+    values += [(keys[i - 1] + "_" + k.lower(), record[k]) for k in keys[i + 1:]]
+    return tags, values, dcs_collection_time_ms(record["CollectionTime"])
+
+_dcs_influx_tag_re = re.compile(r"([,= ])")
+_dcs_influx_measurement_re = re.compile(r"([, ])")
+
+def _dcs_influx_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "{}i".format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+def dcs_influx_line(record):
+    """
+    Serialize a record to an Influx line protocol line (bytes): the
+    objecttype is the measurement, the metadata are the tags and the value
+    (with its Delta and Rate) the fields. Empty when there is no value.
+    """
+    tags, values, ms = _dcs_record_parts(record)
+    values = [(k, v) for k, v in values or () if v is not None]
+    if not values:
+        return b""
+    measurement = record.get("objecttype", record.get("objectname", "datacore"))
+    line = [_dcs_influx_measurement_re.sub(r"\\\1", str(measurement))]
+    for k, v in tags:
+        if k in ("objecttype", "objectname") or v is None or v == "":
+            continue
+        line.append(",{}={}".format(_dcs_influx_tag_re.sub(r"\\\1", k), _dcs_influx_tag_re.sub(r"\\\1", str(v))))
+    line.append(" ")
+    line.append(",".join("{}={}".format(_dcs_influx_tag_re.sub(r"\\\1", k), _dcs_influx_value(v)) for k, v in values))
+    if ms is not None:
+        line.append(" {}".format(ms * 1000000))
+    line.append("\n")
+    return "".join(line).encode("utf-8")
+
+_dcs_graphite_re = re.compile(r"[^A-Za-z0-9_-]+")
+
+def dcs_graphite_encoder(prefix):
+    """
+    Return a function serializing a record to Graphite plaintext lines
+    (bytes): prefix[.target].objecttype.instance.counter value timestamp.
+    Only numeric values are sent, Delta and Rate as counter_delta and
+    counter_rate.
+    """
+    def encode(record):
+        tags, values, ms = _dcs_record_parts(record)
+        if not values:
+            return b""
+        path = [prefix] if prefix else []
+        for key in ("target", "objecttype", "objectname", "instance"):
+            if record.get(key) is not None:
+                path.append(_dcs_graphite_re.sub("_", str(record[key])))
+        timestamp = ms // 1000 if ms is not None else int(time.time())
+        lines = []
+        for k, v in values:
+            if isinstance(v, bool):
+                v = int(v)
+            if not isinstance(v, (int, float)):
                 continue
-            line = '"instance":"{}","objectname":"{}",{},{},{}'
-            objecttype = "DataCore Server Groups"
-            instance = str(data["Alias"])
-            add_info = ',"id":"{}"'.format(str(data["Id"]))
-            for k,v in data["Performances"].items():
-                if "CollectionTime" in k:
-                    continue
-                result.append(line.format(
-                    instance,
-                    objecttype,
-                    add_info,
-                    ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-            for k,v in data["LicenseSettings"].items():
-                if str(k) == "StorageCapacity" or str(k) == "LicensedBulkStorage":
-                    result.append(line.format(
-                        instance,
-                        objecttype,
-                        add_info,
-                        ":".join(['"'+str(k)+'"', '"'+str(v["Value"])+'"']),
-                        '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                    ))
-                else:
-                    result.append(line.format(
-                        instance,
-                        objecttype,
-                        add_info,
-                        ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                        '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                    ))
-
-            # ExistingProductKeys
-            for productkey in data["ExistingProductKeys"]:
-                lastfive = ',"LastFive":"{}"'.format(str(productkey["LastFive"]))
-                for k,v in productkey.items():
-                    if str(k) == "ActualCapacity" or str(k) == "CapacityConsumed":
-                        result.append(line.format(
-                            instance,
-                            objecttype,
-                            add_info + lastfive,
-                            ":".join(['"'+str(k)+'"', '"'+str(v["Value"])+'"']),
-                            '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                        ))
-                    if str(k) == "Capacity" or str(k) == "Capacity":
-                        result.append(line.format(
-                            instance,
-                            objecttype,
-                            add_info + lastfive,
-                            ":".join(['"'+str(k)+'"', '"'+str(v["Value"])+'"']),
-                            '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                        ))
-                    else:
-                        result.append(line.format(
-                            instance,
-                            objecttype,
-                            add_info + lastfive,
-                            ":".join(['"'+str(k)+'"', '"'+str(v)+'"']),
-                            '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                        ))
-
-
-            result.append(line.format(
-                instance,
-                objecttype,
-                add_info,
-                ":".join(['"State"', '"'+str(data["State"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-             ))
-            result.append(line.format(
-                instance,
-                objecttype,
-                add_info,
-                ":".join(['"StorageUsed"', '"'+str(data["StorageUsed"]["Value"])+'"']),
-                '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-             ))
-            
-            if  "NextExpirationDate" in data:
-                result.append(line.format(
-                    instance,
-                    objecttype,
-                    add_info,
-                    ":".join(['"NextExpirationDate"', '"'+str(data["NextExpirationDate"])+'"']),
-                    '"CollectionTime":"'+data["Performances"]["CollectionTime"]+'"'
-                ))
-            
+            lines.append("{}.{} {} {}\n".format(".".join(path), _dcs_graphite_re.sub("_", k), v, timestamp))
+        return "".join(lines).encode("utf-8")
+    return encode
+
+def dcs_record_encoder(settings):
+    """
+    Return a function serializing a record to lines (bytes) in the [OUTPUT]
+    format: json, influx or graphite
+    """
+    name = settings["output_format"]
+    if name == "influx":
+        return dcs_influx_line
+    if name == "graphite":
+        return dcs_graphite_encoder(settings["output_graphite_prefix"])
+    if name != "json":
+        logger.warning("Output format {} not available, using json".format(name))
+    return dcs_json_encoder(settings["output_encoder"])
+
+
+def dcs_compression(name):
+    """
+    Check a [OUTPUT] compress setting: gzip, zstd (when zstandard is
+    installed, gzip otherwise) or None
+    """
+    if name == "zstd" and _dcs_module("zstandard") is None:
+        logger.warning("zstandard not installed, using gzip")
+        return "gzip"
+    if name in ("gzip", "zstd"):
+        return name
+    if name not in ("", "none"):
+        logger.warning("Compression {} not available, not compressing".format(name))
+    return None
+
+_dcs_compress_ext = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+def _dcs_open_file(filename, mode, compress=None):
+    """
+    Open a file to write bytes to, compressed or not. Appending to a
+    compressed file adds a gzip member or a zstd frame, both readable as one.
+    """
+    if compress == "gzip":
+        import gzip
+        return io.BufferedWriter(gzip.open(filename, mode, compresslevel=6), 1024 * 1024)
+    if compress == "zstd":
+        return _dcs_module("zstandard").ZstdCompressor().stream_writer(open(filename, mode), closefd=True)
+    return open(filename, mode, buffering=1024 * 1024)
+
+def _dcs_write_records(out, records, encode, stats):
+    """
+    Encode and write records, accounting the records, bytes and time spent
+    """
+    if stats is None:
+        for record in records:
+            out.write(encode(record))
+        return
+    clock = time.perf_counter
+    for record in records:
+        start = clock()
+        line = encode(record)
+        out.write(line)
+        stats["seconds"] += clock() - start
+        stats["records"] += 1
+        stats["bytes"] += len(line)
+
+def dcs_write_json_lines(records, filename, stats=None, encode=None, compress=None):
+    """
+    Write records as json lines (or as encode makes them) as they are
+    generated, to stdout when filename is "-". A file is written under a
+    temporary name and renamed once complete, so readers never see a
+    partial file.
+    """
+    if encode is None:
+        encode = dcs_json_encoder("auto")
+    if filename == "-":
+        out = sys.stdout.buffer
+        _dcs_write_records(out, records, encode, stats)
+        out.flush()
+        return
+
+    def write(tmp):
+        with _dcs_open_file(tmp, "wb", compress) as f:
+            _dcs_write_records(f, records, encode, stats)
+    _dcs_replace_file(filename, write)
+
+def _dcs_replace_file(filename, write):
+    """
+    Call write() with a temporary name and rename it to filename once
+    complete, so readers never see a partial file
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    tmp = os.path.join(directory, ".{}.{}.tmp".format(name, os.getpid()))
+    try:
+        write(tmp)
+        os.replace(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _dcs_columns(rows):
+    """
+    Union of the columns of rows, in the order they were first seen
+    """
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+    return list(columns)
+
+def _dcs_cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(",", ":"))
+    return value
+
+def dcs_write_csv(rows, filename, stats=None, compress=None):
+    """
+    Write rows as csv, to stdout when filename is "-". The header needs
+    every column: rows are gathered before writing. A missing value is an
+    empty cell.
+    """
+    start = time.perf_counter()
+    rows = list(rows)
+    columns = _dcs_columns(rows)
+
+    import csv
+
+    def write_rows(out):
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_dcs_cell(row.get(c)) for c in columns])
+
+    if filename == "-":
+        write_rows(sys.stdout)
+        sys.stdout.flush()
+    else:
+        def write(tmp):
+            with io.TextIOWrapper(_dcs_open_file(tmp, "wb", compress), encoding="utf-8", newline="") as out:
+                write_rows(out)
+        _dcs_replace_file(filename, write)
+    if stats is not None:
+        stats["seconds"] += time.perf_counter() - start
+        stats["records"] += len(rows)
+        stats["bytes"] += os.path.getsize(filename) if filename != "-" else 0
+
+def _dcs_arrow_column(values):
+    """
+    Arrow array of a column, as strings when its values have mixed types
+    """
+    pyarrow = _dcs_module("pyarrow")
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        return pyarrow.array([None if v is None else str(_dcs_cell(v)) for v in values])
+
+def dcs_write_parquet(rows, filename, stats=None, compress=None):
+    """
+    Write rows as a Parquet file (pyarrow), a column per field. Rows are
+    gathered before writing.
+    """
+    pyarrow = _dcs_module("pyarrow")
+    parquet = _dcs_module("pyarrow.parquet")
+    start = time.perf_counter()
+    rows = list(rows)
+    columns = _dcs_columns(rows)
+    table = pyarrow.Table.from_arrays([_dcs_arrow_column([row.get(c) for row in rows]) for c in columns],
+                                      names=columns)
+    _dcs_replace_file(filename, lambda tmp: parquet.write_table(table, tmp, compression=compress or "snappy"))
+    if stats is not None:
+        stats["seconds"] += time.perf_counter() - start
+        stats["records"] += len(rows)
+        stats["bytes"] += os.path.getsize(filename)
+
+def _dcs_send_records(records, encode, stats, send, max_lines=None, max_bytes=None):
+    """
+    Encode records and give them to send() by batches of at most max_lines
+    lines or max_bytes bytes. A failed batch is logged and counted, the
+    next ones are still sent.
+    """
+    def _send(batch):
+        try:
+            send(b"".join(batch))
+        except (OSError, DcsError) as e:
+            logger.error("Output of {} lines failed: {}".format(len(batch), e))
+            if stats is not None:
+                stats["errors"] += 1
+
+    clock = time.perf_counter
+    batch = []
+    size = 0
+    for record in records:
+        start = clock()
+        line = encode(record)
+        if line:
+            if batch and ((max_lines and len(batch) >= max_lines) or (max_bytes and size + len(line) > max_bytes)):
+                _send(batch)
+                batch = []
+                size = 0
+            batch.append(line)
+            size += len(line)
+        if stats is not None:
+            stats["seconds"] += clock() - start
+            stats["records"] += 1
+            stats["bytes"] += len(line)
+    if batch:
+        start = clock()
+        _send(batch)
+        if stats is not None:
+            stats["seconds"] += clock() - start
+
+
+def dcs_file_sink(pattern, encode, compress):
+    """
+    Sink writing a new file per collection, named after a strftime pattern
+    """
+    def write(records, stats):
+        filename = time.strftime(pattern)
+        if filename != "-":
+            filename += _dcs_compress_ext[compress]
+        dcs_write_json_lines(records, filename, stats, encode, compress)
+    return write
+
+def dcs_table_sink(pattern, fmt, compress):
+    """
+    Sink writing a new csv or Parquet file per collection, named after a
+    strftime pattern
+    """
+    def write(records, stats):
+        filename = time.strftime(pattern)
+        if fmt == "parquet":
+            dcs_write_parquet(records, filename, stats, compress)
+            return
+        if filename != "-":
+            filename += _dcs_compress_ext[compress]
+        dcs_write_csv(records, filename, stats, compress)
+    return write
+
+def dcs_rotating_sink(pattern, encode, compress, max_size, keep):
+    """
+    Sink appending to the file named after a strftime pattern (a new file
+    when the name changes, ex: every hour with %H). A file bigger than
+    max_size bytes is renamed name.N.ext first. Only the keep most recent
+    files are kept (all when 0).
+    """
+    ext = _dcs_compress_ext[compress]
+    root, suffix = os.path.splitext(pattern)
+    files = re.sub(r"%(.)", lambda m: "%" if m.group(1) == "%" else "*", glob.escape(root))
+    files += "*" + suffix + ext
+
+    def write(records, stats):
+        filename = time.strftime(pattern) + ext
+        if max_size and os.path.exists(filename) and os.path.getsize(filename) >= max_size:
+            root, suffix = os.path.splitext(time.strftime(pattern))
+            # After the last one, numbers freed by rotate_keep are not reused
+            rotated = re.compile(re.escape(root) + r"\.(\d+)" + re.escape(suffix + ext) + "$")
+            n = max([int(m.group(1)) for m in map(rotated.match, glob.glob(glob.escape(root) + ".*")) if m] or [0]) + 1
+            os.replace(filename, "{}.{}{}{}".format(root, n, suffix, ext))
+        with _dcs_open_file(filename, "ab", compress) as f:
+            _dcs_write_records(f, records, encode, stats)
+        if keep:
+            old = sorted(glob.glob(files), key=os.path.getmtime)[:-keep]
+            for name in old:
+                if os.path.abspath(name) != os.path.abspath(filename):
+                    os.remove(name)
+    return write
+
+def dcs_http_sink(url, encode, compress, batch_size, content_type, timeout):
+    """
+    Sink POSTing the lines to an url, batch_size lines per request
+    """
+    import requests
+    session = requests.Session()
+    headers = {"Content-Type": content_type}
+    if compress is not None:
+        headers["Content-Encoding"] = compress
+
+    def send(data):
+        if compress == "gzip":
+            import gzip
+            data = gzip.compress(data, 6)
+        elif compress == "zstd":
+            data = _dcs_module("zstandard").ZstdCompressor().compress(data)
+        try:
+            res = session.post(url, data=data, headers=headers, timeout=timeout)
+            res.raise_for_status()
+        except requests.RequestException as e:
+            raise DcsError(str(e))
+
+    def write(records, stats):
+        _dcs_send_records(records, encode, stats, send, max_lines=batch_size)
+    return write
+
+def dcs_socket_sink(kind, address, encode, timeout):
+    """
+    Sink sending the lines to a local agent over udp, tcp ("host:port") or
+    a Unix stream socket (path). Stream connections are kept between
+    collections and reopened once when broken.
+    """
+    if kind == "unix":
+        family, addr = socket.AF_UNIX, address
+    else:
+        host, _, port = address.rpartition(":")
+        family, _, _, _, addr = socket.getaddrinfo(host.strip("[]") or "127.0.0.1", int(port), 0,
+                                                    socket.SOCK_DGRAM if kind == "udp" else socket.SOCK_STREAM)[0]
+    conn = {"sock": None}
+
+    def connect():
+        if kind == "udp":
+            sock = socket.socket(family, socket.SOCK_DGRAM)
         else:
-            logging.error("This resource ({}) is not yet implemented".format(resource))
-    
-    # Create json
-    logging.info("create json file")       
-    data = "}\n{".join(result)
-
-    #print("{"+data+"}")
-    f = open("datacore_perf_"+ time.strftime("%Y%m%d-%H%M%S") +".json", "w")
-    f.write("{"+data+"}")
-    f.close()
-    
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(addr)
+        conn["sock"] = sock
+        return sock
 
+    def send(data):
+        sock = conn["sock"] or connect()
+        if kind == "udp":
+            sock.sendto(data, addr)
+            return
+        try:
+            sock.sendall(data)
+        except OSError:
+            sock.close()
+            conn["sock"] = None
+            connect().sendall(data)
 
+    def write(records, stats):
+        try:
+            # One datagram per batch, below the usual MTU
+            _dcs_send_records(records, encode, stats, send, max_bytes=1400 if kind == "udp" else 65536)
+        except:
+            if conn["sock"] is not None:
+                conn["sock"].close()
+                conn["sock"] = None
+            raise
+    return write
 
+def dcs_make_sink(settings):
+    """
+    Build the [OUTPUT] sink: a function writing the records of a collection,
+    accounting records, bytes, time spent and errors in its stats
+    """
+    name = settings["output_sink"]
+    output_file = settings["output_file"]
+    output_format = settings["output_format"]
+    compress = dcs_compression(settings["output_compress"])
+    timeout = (settings["perf_connect_timeout"], settings["perf_read_timeout"])
+    if output_format in ("csv", "parquet"):
+        fmt = output_format
+        if fmt == "parquet" and _dcs_module("pyarrow") is None:
+            logger.warning("pyarrow not installed, writing csv")
+            fmt = "csv"
+        if name not in ("file", "stdout") or (name == "stdout" and fmt == "parquet"):
+            logger.warning("The {} format is written to files only, using the file sink".format(fmt))
+            name = "file"
+        if output_file.endswith(".json"):
+            # A json lines name, as the default one
+            output_file = output_file[:-len(".json")] + "." + fmt
+        return dcs_table_sink("-" if name == "stdout" else output_file, fmt, compress)
+    encode = dcs_record_encoder(settings)
+    if name == "stdout":
+        return dcs_file_sink("-", encode, None)
+    if name == "rotate":
+        return dcs_rotating_sink(output_file, encode, compress, int(settings["output_rotate_size"] * 1048576),
+                                 settings["output_rotate_keep"])
+    if (name == "http" and not settings["output_url"]) or (name in ("udp", "tcp", "unix") and not settings["output_address"]):
+        logger.error("Output sink {} needs an url/address, using file".format(name))
+        name = "file"
+    if name == "http":
+        content_type = "application/x-ndjson" if output_format == "json" else "text/plain; charset=utf-8"
+        return dcs_http_sink(settings["output_url"], encode, compress, settings["output_batch_size"], content_type, timeout)
+    if name in ("udp", "tcp", "unix"):
+        return dcs_socket_sink(name, settings["output_address"], encode, timeout[1])
+    if name != "file":
+        logger.warning("Output sink {} not available, using file".format(name))
+    return dcs_file_sink(output_file, encode, compress)
 
-if __name__ == "__main__":
-    
-    dcs_servers = {}
 
-    dcs_servers = dcs_get_object("servers")
+def put_in_json_line(records, sink, stats=None):
+    """
+    Write the records of the DataCore objects performances to the sink
+    """
+    logger.info("create json file")
+    sink(records, stats)
+
+
+
+
+def dcs_load_inventory(target):
+    """
+    Load the inventory cache file kept between one-shot runs
+    """
+    cache_file = target["inventory_cache_file"]
+    if not cache_file:
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        logger.info("No usable inventory cache in {}".format(cache_file))
+        return {}
+
+def dcs_save_inventory(target):
+    """
+    Write the inventory cache file (atomically)
+    """
+    cache_file = target["inventory_cache_file"]
+    if not cache_file:
+        return
+    tmp = cache_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(target["inventory"], f)
+    os.replace(tmp, cache_file)
+
+def dcs_invalidate_inventory(target, resource=None):
+    """
+    Force the refresh of one resource (or of all resources) on the next use.
+    The expired lists are kept to be diffed against the fetched ones. A
+    resource expired during a collection is saved once, at its end (see
+    dcs_save_invalidated).
+    """
+    inventory = target["inventory"]
+    if inventory is None:
+        return
+    for name, entry in inventory.items():
+        if resource is None or name == resource:
+            entry["expired"] = True
+    if resource is not None and resource in inventory:
+        target["inventory_invalidated"].add(resource)
+
+def dcs_save_invalidated(target):
+    """
+    Save the inventory when lists were expired during the collection, to
+    keep the next one-shot run from using them
+    """
+    if target["inventory_invalidated"]:
+        target["inventory_invalidated"].clear()
+        dcs_save_inventory(target)
+
+def dcs_get_cached_object(target, dcs_object, deadline=None):
+    """
+    Get DataCore Object from the inventory cache, fetch it when its TTL expired
+    (the [INVENTORY] states_ttl when shorter for the lists carrying states).
+    When the fetch fails the stale list is kept (none when there is no
+    cached list) and the error is kept in the target stats.
+    """
+    settings = target["settings"]
+    ttl = settings["inventory_ttls"].get(dcs_object, settings["inventory_ttl"])
+    if settings["inventory_states_ttl"] is not None and dcs_object in settings["state_resources"]:
+        ttl = min(ttl, settings["inventory_states_ttl"])
+    entry = target["inventory"].get(dcs_object)
+    if dcs_object in target["inventory_fetched"]:
+        # Already fetched during this collection
+        return entry["objects"], False
+    if entry is not None and not entry.get("expired") and time.time() - entry["time"] < ttl:
+        return entry["objects"], False
+    if dcs_object in target["stats"]["inventory_errors"]:
+        # Already failed during this collection
+        return entry["objects"] if entry is not None else [], False
+    try:
+        objects, hashes = dcs_get_object(target, dcs_object, deadline, entry)
+    except DcsError as e:
+        target["stats"]["inventory_errors"][dcs_object] = str(e)
+        if entry is None:
+            logger.error("No {} collected from {}: {}".format(dcs_object, target["rest_server"], e))
+            return [], False
+        logger.warning("Using the stale {} list of {}: {}".format(dcs_object, target["rest_server"], e))
+        return entry["objects"], False
+    if hashes is None or entry is None or entry.get("hashes") is None:
+        # Not diffed, the index is rebuilt from all the lists
+        target["index"] = {}
+    entry = {"time": time.time(), "objects": objects}
+    if hashes is not None:
+        entry["hashes"] = hashes
+    target["inventory"][dcs_object] = entry
+    target["inventory_fetched"].add(dcs_object)
+    return entry["objects"], True
+
+def dcs_get_inventory(target, refresh=False, deadline=None):
+    """
+    Get the DataCore servers and the objects of every enabled resource
+    """
+    if target["inventory"] is None:
+        target["inventory"] = dcs_load_inventory(target)
+    del target["inventory_events"][:]
+    target["inventory_fetched"].clear()
+    target["stats"]["inventory_errors"].clear()
+    if refresh:
+        logger.info("Inventory refresh requested")
+        dcs_invalidate_inventory(target)
+
+    # Servers and hosts are always needed to resolve the ServerId/HostId
+    dcs_servers, updated = dcs_get_cached_object(target, "servers", deadline)
+    dcs_hosts, fetched = dcs_get_cached_object(target, "hosts", deadline)
+    updated = updated or fetched
+    dcs_lists = [dcs_servers, dcs_hosts]
 
-    dcs_servers_hosts = dcs_servers + dcs_get_object("hosts")
-    resources = [r for r in config['RESOURCES'] if config['RESOURCES'].getboolean(r)]
-    
     dcs_objects = []
-    for resource in resources:
-        dcs_objects += dcs_get_object(resource)
-    
-    dcs_perfs = dcs_get_perf(dcs_objects)
+    for resource in target["settings"]["resources"]:
+        objects, fetched = dcs_get_cached_object(target, resource, deadline)
+        dcs_objects += objects
+        if resource not in ("servers", "hosts"):
+            dcs_lists.append(objects)
+        updated = updated or fetched
+    if not target["index"]:
+        target["index"] = dcs_build_index(dcs_lists)
+        target["meta_cache"].clear()
+    else:
+        dcs_invalidate_meta(target, target["inventory_events"])
+        dcs_update_index(target["index"], target["inventory_events"])
+    if updated:
+        target["inventory_invalidated"].clear()
+        dcs_save_inventory(target)
+    else:
+        dcs_save_invalidated(target)
+    return dcs_objects
+
 
-    put_in_json_line(dcs_perfs)
-  
+def dcs_inventory_error_records(target):
+    """
+    Records of the object lists that could not be fetched from a target
+    """
+    if target["settings"]["shard_index"] != 0:
+        # Every shard fetches the whole inventory, the first one reports
+        return
+    collection_time = "/Date({})/".format(int(time.time() * 1000))
+    meta = {"instance": target["name"], "objecttype": "DataCore Collector"}
+    for resource, error in sorted(target["stats"]["inventory_errors"].items()):
+        yield dcs_record(dict(meta, resource=resource), "Error", error, collection_time)
+
+def dcs_inventory_event_records(target):
+    """
+    Records of the objects added, removed or changed by the last inventory
+    refresh ([INVENTORY] events), in the shard of the collector
+    """
+    settings = target["settings"]
+    if not settings["inventory_events"]:
+        return
+    for dcs_object, event, item in target["inventory_events"]:
+        if dcs_in_shard(settings, item["Id"]):
+            yield dcs_object_record(target, dcs_object, item, "InventoryEvent", event)
+
+def dcs_collect_target(target, refresh=False, deadline=None):
+    """
+    Generate the records of one collection of a target
+    """
+    stats = target["stats"] = dcs_new_stats()
+    start = time.perf_counter()
+    dcs_objects = dcs_filter_objects(target, dcs_get_inventory(target, refresh, deadline))
+    stats["stages"]["inventory"] = time.perf_counter() - start
+    for record in dcs_inventory_error_records(target):
+        yield record
+    for record in dcs_inventory_event_records(target):
+        yield record
+    for record in dcs_json_lines(target, dcs_get_perf(target, dcs_objects, deadline)):
+        yield record
+    dcs_save_invalidated(target)
+    if target["settings"]["rates_enabled"]:
+        dcs_save_samples(target)
+    stats["stages"]["target"] = time.perf_counter() - start
+    logger.info("Collected {} records from {} in {:.3f}s (inventory {:.3f}s, perf {:.3f}s, format {:.3f}s), {} errors, {} failed objects".format(
+        stats["records"], target["rest_server"], stats["stages"]["target"],
+        stats["stages"]["inventory"], stats["stages"].get("perf", 0),
+        stats["stages"].get("format", 0), stats["errors"], stats["failed"]))
+
+
+def _dcs_target_stats_records(target, meta, collection_time):
+    """
+    Self-metric records of the last collection of a target
+    """
+    stats = target["stats"]
+    for stage, seconds in sorted(stats["stages"].items()):
+        yield dcs_record(meta, stage.capitalize() + "Seconds", seconds, collection_time)
+    for key, name in (("objects", "Objects"), ("filtered", "FilteredObjects"), ("requests", "Requests"), ("saved", "RoundTripsSaved"),
+                      ("errors", "Errors"), ("retries", "Retries"), ("failed", "FailedObjects"),
+                      ("bytes", "BytesReceived"), ("records", "Records"),
+                      ("concurrency", "PerfConcurrency"), ("backoffs", "ConcurrencyBackoffs")):
+        yield dcs_record(meta, name, stats[key], collection_time)
+    settings = target["settings"]
+    if settings["shard_count"] > 1:
+        # Shares of all the shards sum to 1 when every collector runs
+        yield dcs_record(meta, "ShardIndex", settings["shard_index"], collection_time)
+        yield dcs_record(meta, "ShardCount", settings["shard_count"], collection_time)
+        yield dcs_record(meta, "InventoryObjects", stats["inventory_objects"], collection_time)
+        yield dcs_record(meta, "ShardCoverage", float(stats["objects"]) / stats["inventory_objects"]
+                         if stats["inventory_objects"] else 0.0, collection_time)
+    for (call, resource), http in sorted(stats["http"].items()):
+        http_meta = dict(meta, call=call, resource=resource)
+        yield dcs_record(http_meta, "HttpRequests", http["count"], collection_time)
+        yield dcs_record(http_meta, "HttpErrors", http["errors"], collection_time)
+        yield dcs_record(http_meta, "HttpRetries", http["retries"], collection_time)
+        yield dcs_record(http_meta, "HttpBytes", http["bytes"], collection_time)
+        yield dcs_record(http_meta, "HttpSeconds", http["seconds"], collection_time)
+        # Cumulative buckets, "le" is the upper bound in seconds
+        count = 0
+        for bound, n in zip(DCS_LATENCY_BUCKETS + ("+Inf",), http["buckets"]):
+            count += n
+            yield dcs_record(dict(http_meta, le=str(bound)), "HttpLatencyBucket", count, collection_time)
+
+def dcs_stats_records(targets, settings, cycle):
+    """
+    Generate the collector self-metric records (objecttype "DataCore
+    Collector") of a collection: per target, then for the whole collection.
+    They go to the output when [STATS] enabled and to [STATS] file.
+    """
+    collection_time = "/Date({})/".format(int(time.time() * 1000))
+    host = socket.gethostname()
+    shard = {"shard": str(settings["shard_index"])} if settings["shard_count"] > 1 else {}
+    records = []
+    for target in targets:
+        meta = dict({"instance": target["name"], "objecttype": "DataCore Collector", "host": host}, **shard)
+        records.extend(_dcs_target_stats_records(target, meta, collection_time))
+
+    meta = dict({"instance": "collector", "objecttype": "DataCore Collector", "host": host}, **shard)
+    write = cycle["write"]
+    records.append(dcs_record(meta, "WriteSeconds", write["seconds"], collection_time))
+    records.append(dcs_record(meta, "RecordsWritten", write["records"], collection_time))
+    records.append(dcs_record(meta, "BytesWritten", write["bytes"], collection_time))
+    records.append(dcs_record(meta, "WriteErrors", write["errors"], collection_time))
+    records.append(dcs_record(meta, "CycleSeconds", time.perf_counter() - cycle["start"], collection_time))
+    if rusage is not None:
+        # kilobytes on Linux, bytes on macOS
+        peak = rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss
+        records.append(dcs_record(meta, "PeakRssBytes", peak if sys.platform == "darwin" else peak * 1024, collection_time))
+
+    if settings["stats_file"]:
+        dcs_write_json_lines(iter(records), time.strftime(settings["stats_file"]))
+    if settings["stats_enabled"]:
+        for record in dcs_widen(records) if settings["output_layout"] == "wide" else records:
+            yield record
+
+# Records buffered between the collections of several targets and the sink
+DCS_MERGE_QUEUE_SIZE = 10000
+
+def dcs_merge(generators):
+    """
+    Run named generators concurrently, one thread each, and generate their
+    items as they come. A failing generator is logged and the others go on.
+    The producers wait for the consumer when DCS_MERGE_QUEUE_SIZE items are
+    pending, and give up once it is closed.
+    """
+    items = queue.Queue(DCS_MERGE_QUEUE_SIZE)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(name, generator):
+        try:
+            for item in generator:
+                if not _put(item):
+                    break
+        except Exception as e:
+            logger.error("Collection of {} failed: {}".format(name, e))
+        finally:
+            generator.close()
+            _put(done)
+
+    for name, generator in generators:
+        threading.Thread(target=_run, args=(name, generator), daemon=True).start()
+    try:
+        running = len(generators)
+        while running:
+            item = items.get()
+            if item is done:
+                running -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+
+def dcs_new_cycle():
+    """
+    State of one collection: its start and what was written
+    """
+    return {"start": time.perf_counter(), "write": {"records": 0, "bytes": 0, "seconds": 0.0, "errors": 0}}
+
+def dcs_iter_records(targets, settings, cycle, refresh=False, deadline=None):
+    """
+    Generate the records of one collection of every target, concurrently,
+    then the self-metric records
+    """
+    if len(targets) == 1:
+        records = dcs_collect_target(targets[0], refresh, deadline)
+    else:
+        records = dcs_merge([(target["name"], dcs_collect_target(target, refresh, deadline))
+                             for target in targets])
+    if settings["stats_enabled"] or settings["stats_file"]:
+        # Evaluated once every other record was written
+        records = itertools.chain(records, dcs_stats_records(targets, settings, cycle))
+    return records
+
+
+class DataCoreCollector(object):
+    """
+    Collector of the perf of the DataCore server groups of a config
+    (configparser.ConfigParser, path of an ini file or dict of sections).
+    Nothing is fetched before the first call.
+    """
+
+    def __init__(self, config):
+        self.config = dcs_read_config(config)
+        self.settings = dcs_settings(self.config)
+        self.targets = dcs_targets(self.config, self.settings)
+        self.sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _deadline(self, deadline):
+        if deadline is None:
+            deadline = self.settings["perf_deadline"]
+        return time.monotonic() + deadline if deadline else None
+
+    def inventory(self, refresh=False):
+        """
+        Get the objects to collect of every target: {target name: objects}
+        """
+        return dict((target["name"], dcs_filter_objects(target, dcs_get_inventory(target, refresh)))
+                    for target in self.targets)
+
+    def iter_records(self, refresh=False, deadline=None, cycle=None):
+        """
+        Generate the records of one collection of every target, without
+        writing them. The collection stops waiting for perf deadline seconds
+        after it started ([PERF] deadline when not given, no limit when 0).
+        """
+        if cycle is None:
+            cycle = dcs_new_cycle()
+        return dcs_iter_records(self.targets, self.settings, cycle, refresh, self._deadline(deadline))
+
+    def collect(self, refresh=False, deadline=None):
+        """
+        Collect the perf of every target and write them to the [OUTPUT] sink.
+        Return what was written (records, bytes, seconds, errors).
+        """
+        if self.sink is None:
+            self.sink = dcs_make_sink(self.settings)
+        cycle = dcs_new_cycle()
+        put_in_json_line(self.iter_records(refresh, deadline, cycle), self.sink, cycle["write"])
+        logger.info("Collection done in {:.3f}s, {} records written in {:.3f}s".format(
+            time.perf_counter() - cycle["start"], cycle["write"]["records"], cycle["write"]["seconds"]))
+        return cycle["write"]
+
+    def run(self, refresh_first=False, stop=None, refresh=None):
+        """
+        Collect perf every [DAEMON] interval seconds until the stop event is
+        set. Without one, SIGINT/SIGTERM stop and SIGHUP refreshes the
+        inventory: the handlers are installed for the run (call it from the
+        main thread) and the previous ones restored after. Setting the
+        refresh event refreshes the inventory at the next cycle.
+        Cycles are aligned on a fixed schedule, an overrunning cycle makes the
+        next ones be skipped instead of stacked, and a cycle stops waiting for
+        perf after [PERF] deadline (the interval when 0).
+        """
+        interval = self.settings["daemon_interval"]
+        if refresh is None:
+            refresh = threading.Event()
+        if refresh_first:
+            refresh.set()
+        handlers = {}
+        if stop is None:
+            stop = threading.Event()
+
+            def _stop(signum, frame):
+                logger.info("Signal {} received, stopping after the current cycle".format(signum))
+                stop.set()
+
+            def _refresh(signum, frame):
+                refresh.set()
+
+            handlers[signal.SIGINT] = _stop
+            handlers[signal.SIGTERM] = _stop
+            if hasattr(signal, "SIGHUP"):
+                handlers[signal.SIGHUP] = _refresh
+        previous = dict((signum, signal.signal(signum, handler)) for signum, handler in handlers.items())
+
+        try:
+            self._run(interval, stop, refresh)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def _run(self, interval, stop, refresh):
+        logger.info("Daemon mode, collecting every {}s".format(interval))
+        start = time.monotonic()
+        tick = 0
+        while not stop.is_set():
+            try:
+                refresh_all = refresh.is_set()
+                refresh.clear()
+                self.collect(refresh_all, self.settings["perf_deadline"] or interval)
+            except Exception as e:
+                logger.error("Collection failed: {}".format(e))
+
+            tick += 1
+            now = time.monotonic()
+            next_tick = start + tick * interval
+            if now > next_tick:
+                skipped = int((now - next_tick) // interval) + 1
+                logger.warning("Collection overran the interval, skipping {} cycle(s)".format(skipped))
+                tick += skipped
+                next_tick = start + tick * interval
+            stop.wait(next_tick - now)
+        logger.info("Daemon stopped")
+
+    def close(self):
+        """
+        Release the executors and the HTTP sessions
+        """
+        dcs_shutdown(self.targets)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Get DataCore performances to json")
+    parser.add_argument("--config", default="./datacore_get_perf.ini",
+                        help="config file (default: ./datacore_get_perf.ini)")
+    parser.add_argument("--refresh-inventory", action="store_true",
+                        help="ignore the cached inventory and fetch every object list")
+    parser.add_argument("--shard-index", type=int,
+                        help="shard collected by this process (default: [SHARDING] index)")
+    args = parser.parse_args(argv)
+
+    try:
+        config = dcs_read_config(args.config)
+    except DcsError:
+        print("Config file ({}) not found".format(args.config))
+        sys.exit(1)
+    if args.shard_index is not None:
+        if not config.has_section('SHARDING'):
+            config.add_section('SHARDING')
+        config.set('SHARDING', 'index', str(args.shard_index))
+    dcs_setup_logging(config)
+    if _dcs_module("requests") is None:
+        msg_error_import("requests")
+
+    try:
+        collector = DataCoreCollector(config)
+    except DcsError as e:
+        print(e)
+        sys.exit(1)
+    with collector:
+        if collector.settings["daemon_mode"]:
+            collector.run(args.refresh_inventory)
+        else:
+            collector.collect(args.refresh_inventory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#coding:utf-8
+"""
+Local stand-in for the DataCore REST service, serving synthetic objects and
+performances at a configurable scale and latency (for benchmarks and tests)
+"""
+import sys
+import argparse
+import json
+import time
+import random
+import threading
+try:
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    print("Need python 3.7 or later")
+    sys.exit(1)
+
+
+REST_PREFIX = "/RestService/rest.svc/1.0/"
+
+
+def make_inventory(servers=2, hosts=10, pools=4, virtualdisks=100, physicaldisks=20, ports=8):
+    """
+    Build synthetic DataCore objects lists, shaped like the REST service ones
+    """
+    inventory = {}
+    inventory["servers"] = [{
+        "Id": "server-{}".format(i),
+        "Caption": "SDS{}".format(i),
+        "ExtendedCaption": "SDS{} in Group".format(i),
+        "RegionNodeId": "node-{}".format(i),
+        "OsVersion": "Windows Server 2019",
+        "ProductBuild": "15.0.1400.0",
+        "ProductVersion": "10.0",
+        "ProductName": "SANsymphony",
+        "ProductType": "Standard",
+        "State": 2,
+        "CacheState": 1,
+        "PowerState": 1,
+    } for i in range(servers)]
+    # A partner server, dropped by the collector
+    inventory["servers"].append({
+        "Id": "partner-0", "Caption": "PARTNER", "ExtendedCaption": "PARTNER",
+        "RegionNodeId": None,
+    })
+    server_ids = [s["Id"] for s in inventory["servers"][:servers]] or [None]
+
+    inventory["hosts"] = [{
+        "Id": "host-{}".format(i),
+        "Caption": "HOST{}".format(i),
+        "ExtendedCaption": "HOST{}".format(i),
+        "MpioCapable": True,
+        "AluaSupport": i % 2 == 0,
+        "State": 1,
+    } for i in range(hosts)]
+    host_ids = [h["Id"] for h in inventory["hosts"]] or [None]
+
+    inventory["pools"] = [{
+        "Id": "pool-{}".format(i),
+        "Caption": "Pool {}".format(i),
+        "ExtendedCaption": "Pool {} on {}".format(i, server_ids[i % len(server_ids)]),
+        "ServerId": server_ids[i % len(server_ids)],
+        "InSharedMode": False,
+        "AutoTieringEnabled": True,
+        "PoolStatus": 0,
+        "TierReservedPct": 0,
+        "ChunkSize": {"Value": 134217728},
+        "MaxTierNumber": 3,
+    } for i in range(pools)]
+
+    inventory["virtualdisks"] = [{
+        "Id": "vdisk-{}".format(i),
+        "Caption": "Virtual disk {}".format(i),
+        "ExtendedCaption": "Virtual disk {}".format(i),
+        # One in ten has no storage profile and is not reported
+        "StorageProfileId": None if i % 10 == 9 else "profile-normal",
+        "ScsiDeviceIdString": "60030D90{:024X}".format(i),
+        "Type": 2,
+        "FirstHostId": server_ids[i % len(server_ids)],
+        "SecondHostId": server_ids[(i + 1) % len(server_ids)],
+        "DiskStatus": 0,
+        "Size": {"Value": 1099511627776},
+    } for i in range(virtualdisks)]
+
+    inventory["physicaldisks"] = [{
+        "Id": "pdisk-{}".format(i),
+        "Caption": "Disk {}".format(i),
+        "ExtendedCaption": "Disk {} on {}".format(i, server_ids[i % len(server_ids)]),
+        "HostId": server_ids[i % len(server_ids)],
+        # Only Type 4 (pool disks) are reported
+        "Type": 4 if i % 4 else 1,
+        "InquiryData": {"Serial": "SN{:08d}".format(i) if i % 5 else None},
+        "DiskStatus": 0,
+    } for i in range(physicaldisks)]
+
+    inventory["ports"] = [{
+        "Id": "port-{}".format(i),
+        # Loopback and Microsoft iSCSI ports are dropped by the collector
+        "Caption": "Loopback Port {}".format(i) if i % 8 == 7 else "FC Port {}".format(i),
+        "ExtendedCaption": "FC Port {}".format(i),
+        "HostId": host_ids[i % len(host_ids)] if i % 2 else server_ids[i % len(server_ids)],
+        "__type": "ServerFcPortData:#DataCore.Executive.Controller",
+        "PortType": 2,
+        "ServerPortProperties": {"Role": 1},
+    } for i in range(ports)]
+
+    inventory["servergroups"] = [{
+        "Id": "group-0",
+        "Caption": "Group",
+        "Alias": "Group",
+        "OurGroup": True,
+        "State": 0,
+        "StorageUsed": {"Value": 10995116277760},
+        "NextExpirationDate": "/Date(1893456000000)/",
+        "LicenseSettings": {"StorageCapacity": {"Value": 109951162777600},
+                            "LicensedBulkStorage": {"Value": 0},
+                            "MaxServers": 64},
+        "ExistingProductKeys": [{"LastFive": "ABCDE",
+                                 "ActualCapacity": {"Value": 109951162777600},
+                                 "CapacityConsumed": {"Value": 10995116277760},
+                                 "Capacity": {"Value": 109951162777600}}],
+    }]
+    return inventory
+
+
+def make_performance(dcs_id, counters=20):
+    """
+    Build a synthetic performance sample: cumulative counters growing with time
+    """
+    now = time.time()
+    seed = sum(ord(c) for c in dcs_id)
+    perf = {"CollectionTime": "/Date({})/".format(int(now * 1000))}
+    for i in range(counters):
+        perf["TotalCounter{:02d}".format(i)] = int(now * (seed + i + 1))
+    perf["PendingCommands"] = seed % 8
+    return perf
+
+
+def make_handler(inventory, counters=20, latency=0.0, batch=True, error_rate=0.0, batch_omit=()):
+    """
+    Build the request handler serving an inventory. A fraction error_rate
+    of the perf requests get an HTTP 500. The Ids of batch_omit are left out
+    of the batched perf responses.
+    """
+    ids = set(o["Id"] for objects in inventory.values() for o in objects)
+
+    class DataCoreHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, don't let Nagle delay them
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            if not self.path.startswith(REST_PREFIX):
+                self.send_json(404, {"ErrorCode": 404, "Message": "Not found"})
+                return
+            parts = self.path[len(REST_PREFIX):].split("?")[0].split("/")
+            if parts[0].startswith("performance") and error_rate and random.random() < error_rate:
+                self.send_json(500, {"ErrorCode": 500, "Message": "Internal error"})
+            elif parts[0] == "performance" and len(parts) == 2:
+                self.send_json(200, [make_performance(parts[1], counters)] if parts[1] in ids else [])
+            elif parts[0] == "performancebytype" and len(parts) == 2 and batch:
+                if parts[1] not in inventory:
+                    self.send_json(404, {"ErrorCode": 404, "Message": "Unknown type"})
+                    return
+                self.send_json(200, [{"ObjectId": o["Id"], "PerformanceData": make_performance(o["Id"], counters)}
+                                     for o in inventory[parts[1]] if o["Id"] not in batch_omit])
+            elif parts[0] in inventory and len(parts) == 1:
+                self.send_json(200, inventory[parts[0]])
+            else:
+                self.send_json(404, {"ErrorCode": 404, "Message": "Unknown resource"})
+
+    return DataCoreHandler
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The collector opens up to max_workers connections at once
+    request_queue_size = 128
+
+
+def serve(host="127.0.0.1", port=8080, counters=20, latency=0.0, batch=True, error_rate=0.0, batch_omit=(), **scale):
+    """
+    Create the mock server (call serve_forever() on it, or run it in a thread)
+    """
+    return MockServer((host, port), make_handler(make_inventory(**scale), counters, latency, batch, error_rate, batch_omit))
+
+
+def serve_in_thread(**kwargs):
+    """
+    Start the mock server in a daemon thread, return the server
+    """
+    server = serve(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Mock DataCore REST server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--servers", type=int, default=2)
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--pools", type=int, default=4)
+    parser.add_argument("--virtualdisks", type=int, default=100)
+    parser.add_argument("--physicaldisks", type=int, default=20)
+    parser.add_argument("--ports", type=int, default=8)
+    parser.add_argument("--counters", type=int, default=20, help="perf counters per object")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--no-batch", action="store_true", help="don't serve /performancebytype")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of perf requests answered HTTP 500")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.counters, args.latency, not args.no_batch, args.error_rate,
+                   servers=args.servers, hosts=args.hosts, pools=args.pools,
+                   virtualdisks=args.virtualdisks, physicaldisks=args.physicaldisks,
+                   ports=args.ports)
+    print("Mock DataCore REST server on http://{}:{}{}".format(args.host, args.port, REST_PREFIX))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
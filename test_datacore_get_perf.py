@@ -0,0 +1,640 @@
+#coding:utf-8
+"""
+Tests of the collector against the mock DataCore REST server
+"""
+import os
+import json
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+import datacore_get_perf as dcs
+import datacore_mock_server as mock
+
+
+SCALE = {"servers": 2, "hosts": 3, "pools": 2, "virtualdisks": 20, "physicaldisks": 8, "ports": 4}
+
+
+def make_collector(port, inventory=None, output=None, **perf):
+    """
+    Collector of the mock server on port, with [INVENTORY], [OUTPUT] and
+    [PERF] options
+    """
+    config = {
+        "SERVERS": {"rest_server": "127.0.0.1:{}".format(port), "datacore_server": "mock"},
+        "CREDENTIALS": {"user": "test", "passwd": "test"},
+        "RESOURCES": dict((r, "yes") for r in ("servers", "pools", "virtualdisks", "physicaldisks", "hosts")),
+        "PERF": dict({"batch_url": "performancebytype/{resource}", "retries": "0", "adaptive": "no"}, **perf),
+        "INVENTORY": dict({"cache_file": ""}, **(inventory or {})),
+        "STATS": {"enabled": "yes"},
+    }
+    if output:
+        config["OUTPUT"] = output
+    return dcs.DataCoreCollector(config)
+
+
+class BatchingTest(unittest.TestCase):
+
+    def start(self, **kwargs):
+        server = mock.serve_in_thread(port=0, **dict(SCALE, **kwargs))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        collector = make_collector(server.server_address[1])
+        self.addCleanup(collector.close)
+        return collector
+
+    def collect(self, collector):
+        target = collector.targets[0]
+        objects = collector.inventory()[target["name"]]
+        datas = list(dcs.dcs_get_perf(target, objects))
+        return target, objects, datas
+
+    def test_batched(self):
+        target, objects, datas = self.collect(self.start())
+        self.assertEqual(len(datas), len(objects))
+        self.assertTrue(all("Performances" in d for d in datas))
+        # One request per resource
+        resources = set(o["dcs_resource"] for o in objects)
+        self.assertEqual(target["stats"]["requests"], len(resources))
+        self.assertEqual(target["batch_unsupported"], set())
+
+    def test_batch_flat_entry_without_id(self):
+        entry = {"ObjectId": "vdisk-1", "CollectionTime": "/Date(0)/", "TotalReads": 1}
+        self.assertEqual(dcs._dcs_batch_payload(entry, "ObjectId"),
+                         {"CollectionTime": "/Date(0)/", "TotalReads": 1})
+
+    def test_not_batched_falls_back(self):
+        target, objects, datas = self.collect(self.start(batch=False))
+        self.assertEqual(len(datas), len(objects))
+        self.assertTrue(all("Performances" in d for d in datas))
+        resources = set(o["dcs_resource"] for o in objects)
+        self.assertEqual(target["batch_unsupported"], resources)
+        # A failed batch per resource, then one request per object
+        self.assertEqual(target["stats"]["requests"], len(resources) + len(objects))
+        self.assertEqual(target["stats"]["failed"], 0)
+
+    def test_missing_ids_requested_alone(self):
+        missing = ("vdisk-3", "pool-1")
+        target, objects, datas = self.collect(self.start(batch_omit=missing))
+        self.assertEqual(len(datas), len(objects))
+        self.assertTrue(all("Performances" in d for d in datas))
+        self.assertEqual(set(d["Id"] for d in datas), set(o["Id"] for o in objects))
+        resources = set(o["dcs_resource"] for o in objects)
+        self.assertEqual(target["stats"]["requests"], len(resources) + len(missing))
+        # Batching still used for these resources
+        self.assertEqual(target["batch_unsupported"], set())
+
+    def test_round_trips_saved(self):
+        collector = self.start(batch_omit=("vdisk-3",))
+        records = list(collector.iter_records())
+        target = collector.targets[0]
+        stats = [r for r in records if r.get("objecttype") == "DataCore Collector" and r["instance"] == target["name"]]
+        saved = [r["RoundTripsSaved"] for r in stats if "RoundTripsSaved" in r]
+        objects = [r["Objects"] for r in stats if "Objects" in r]
+        requests = [r["Requests"] for r in stats if "Requests" in r]
+        resources = len(set(o["dcs_resource"] for o in collector.inventory()[target["name"]]))
+        self.assertEqual(requests, [resources + 1])
+        self.assertEqual(saved, [objects[0] - resources - 1])
+        self.assertGreater(saved[0], 0)
+
+
+class PerfErrorTest(unittest.TestCase):
+
+    def start(self, status):
+        handler = mock.make_handler(mock.make_inventory(**SCALE))
+
+        class Refusing(handler):
+            def do_GET(self):
+                if self.path.startswith(mock.REST_PREFIX + "performance"):
+                    self.send_json(status, {"ErrorCode": status, "Message": "Refused"})
+                else:
+                    handler.do_GET(self)
+
+        server = mock.MockServer(("127.0.0.1", 0), Refusing)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        collector = make_collector(server.server_address[1], batch_url="")
+        self.addCleanup(collector.close)
+        return collector
+
+    def test_http_error_is_error_record(self):
+        collector = self.start(401)
+        target = collector.targets[0]
+        objects = collector.inventory()[target["name"]]
+        records = list(collector.iter_records())
+        errors = [r for r in records if "Error" in r and "id" in r]
+        self.assertEqual(len(errors), len(objects))
+        self.assertEqual(set(r["Error"] for r in errors), set(["HTTP 401"]))
+        self.assertEqual(target["stats"]["failed"], len(objects))
+        # Not taken for unknown Ids
+        self.assertTrue(all(not e.get("expired") for e in target["inventory"].values()))
+
+
+class InventoryCacheTest(unittest.TestCase):
+
+    def collector(self, cache_file, inventory=None, **scale):
+        server = mock.serve_in_thread(port=0, **dict(SCALE, **scale))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        collector = make_collector(server.server_address[1], batch_url="",
+                                   inventory=dict({"cache_file": cache_file}, **(inventory or {})))
+        self.addCleanup(collector.close)
+        return collector
+
+    def fetched(self, collector):
+        """
+        Resources whose list is fetched by a collection
+        """
+        fetched = []
+        get_object = dcs.dcs_get_object
+        dcs.dcs_get_object = lambda target, resource, *args: (fetched.append(resource), get_object(target, resource, *args))[1]
+        try:
+            list(collector.iter_records())
+        finally:
+            dcs.dcs_get_object = get_object
+        return fetched
+
+    def test_lists_cached(self):
+        collector = self.collector("")
+        self.assertIn("virtualdisks", self.fetched(collector))
+        self.assertEqual(self.fetched(collector), [])
+        # States of the cached lists get the time they were fetched
+        target = collector.targets[0]
+        records = [r for r in collector.iter_records() if "DiskStatus" in r and r["id"].startswith("vdisk-")]
+        self.assertTrue(records)
+        self.assertEqual(set(r["CollectionTime"] for r in records),
+                         set([dcs.dcs_states_time(target, "virtualdisks", None)]))
+
+    def test_states_ttl(self):
+        collector = self.collector("", inventory={"states_ttl": "0"})
+        self.fetched(collector)
+        fetched = self.fetched(collector)
+        self.assertIn("virtualdisks", fetched)
+        self.assertNotIn("ports", fetched)
+
+    def test_unknown_ids_save_once(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        cache_file = os.path.join(workdir, "inventory.json")
+        list(self.collector(cache_file, virtualdisks=200).iter_records())
+
+        collector = self.collector(cache_file, virtualdisks=10)
+        saves = []
+        save = dcs.dcs_save_inventory
+        dcs.dcs_save_inventory = lambda target: (saves.append(1), save(target))
+        try:
+            list(collector.iter_records())
+        finally:
+            dcs.dcs_save_inventory = save
+        self.assertEqual(len(saves), 1)
+        with open(cache_file) as f:
+            self.assertTrue(json.load(f)["virtualdisks"].get("expired"))
+
+
+class EmbeddingTest(unittest.TestCase):
+
+    def serve(self, port=0):
+        server = mock.serve_in_thread(port=port, **SCALE)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_inventory_retried_after_failure(self):
+        server = self.serve()
+        port = server.server_address[1]
+        server.shutdown()
+        server.server_close()
+        collector = make_collector(port)
+        self.addCleanup(collector.close)
+        target = collector.targets[0]
+        self.assertEqual(collector.inventory()[target["name"]], [])
+        self.assertIn("servers", target["stats"]["inventory_errors"])
+
+        self.serve(port)
+        objects = collector.inventory()[target["name"]]
+        self.assertTrue(objects)
+        self.assertEqual(target["stats"]["inventory_errors"], {})
+        self.assertEqual(collector.inventory(refresh=True)[target["name"]], objects)
+
+
+class DiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.target = {"settings": dcs.dcs_settings(dcs.configparser.ConfigParser()), "inventory_events": []}
+        self.items = mock.make_inventory(**SCALE)["virtualdisks"]
+
+    def diff(self, items, previous=None):
+        del self.target["inventory_events"][:]
+        objects, hashes = dcs.dcs_diff_objects(self.target, "virtualdisks", json.loads(json.dumps(items)), previous)
+        return {"objects": objects, "hashes": hashes}
+
+    def test_state_change_is_no_event(self):
+        previous = self.diff(self.items)
+        self.items[0]["DiskStatus"] = 3
+        self.items[0]["Size"]["Value"] += 1
+        entry = self.diff(self.items, previous)
+        self.assertEqual(self.target["inventory_events"], [])
+        self.assertEqual(entry["hashes"], previous["hashes"])
+        # The states are the fetched ones
+        self.assertEqual(entry["objects"][0]["DiskStatus"], 3)
+
+    def test_metadata_change_is_event(self):
+        previous = self.diff(self.items)
+        self.items[0]["Caption"] = "Renamed"
+        del self.items[1]
+        self.diff(self.items, previous)
+        events = sorted((event, item["Id"]) for _, event, item in self.target["inventory_events"])
+        self.assertEqual(events, [("changed", "vdisk-0"), ("removed", "vdisk-1")])
+
+
+class RatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.target = self.make_target()
+
+    def make_target(self, max_age="86400"):
+        config = dcs.configparser.ConfigParser()
+        config.read_dict({"RATES": {"enabled": "yes", "counters": "Total*", "max_age": max_age}})
+        return {"settings": dcs.dcs_settings(config), "samples": None,
+                "rates_state_file": os.path.join(self.workdir, "state.json")}
+
+    def perf(self, seconds, **counters):
+        return dict(counters, CollectionTime="/Date({})/".format(int(seconds * 1000)))
+
+    def test_rates(self):
+        self.assertEqual(dcs.dcs_rates(self.target, "vdisk-1", self.perf(1000, TotalReads=100, Latency=5)), {})
+        rates = dcs.dcs_rates(self.target, "vdisk-1", self.perf(1010, TotalReads=150, Latency=7))
+        # Only the cumulative counters
+        self.assertEqual(rates, {"TotalReads": (50, 5.0)})
+
+    def test_counter_reset(self):
+        dcs.dcs_rates(self.target, "vdisk-1", self.perf(1000, TotalReads=100, TotalWrites=10))
+        rates = dcs.dcs_rates(self.target, "vdisk-1", self.perf(1010, TotalReads=20, TotalWrites=30))
+        self.assertEqual(rates, {"TotalWrites": (20, 2.0)})
+        # The reset value is the next reference
+        rates = dcs.dcs_rates(self.target, "vdisk-1", self.perf(1020, TotalReads=40, TotalWrites=30))
+        self.assertEqual(rates, {"TotalReads": (20, 2.0), "TotalWrites": (0, 0.0)})
+
+    def test_same_sample(self):
+        dcs.dcs_rates(self.target, "vdisk-1", self.perf(1000, TotalReads=100))
+        self.assertEqual(dcs.dcs_rates(self.target, "vdisk-1", self.perf(1000, TotalReads=150)), {})
+        self.assertEqual(dcs.dcs_rates(self.target, "vdisk-1", self.perf(990, TotalReads=150)), {})
+        # Still against the first sample
+        rates = dcs.dcs_rates(self.target, "vdisk-1", self.perf(1010, TotalReads=200))
+        self.assertEqual(rates, {"TotalReads": (100, 10.0)})
+
+    def test_state_file(self):
+        now = time.time()
+        dcs.dcs_rates(self.target, "vdisk-1", self.perf(now, TotalReads=100))
+        dcs.dcs_rates(self.target, "vdisk-2", self.perf(now - 7200, TotalReads=100))
+        dcs.dcs_save_samples(self.target)
+
+        target = self.make_target()
+        rates = dcs.dcs_rates(target, "vdisk-1", self.perf(now + 10, TotalReads=130))
+        self.assertEqual(rates, {"TotalReads": (30, 3.0)})
+        self.assertIn("vdisk-2", target["samples"])
+
+        # Samples older than max_age are forgotten
+        target = self.make_target(max_age="3600")
+        target["samples"] = dcs.dcs_load_samples(target)
+        dcs.dcs_save_samples(target)
+        self.assertEqual(sorted(dcs.dcs_load_samples(target)), ["vdisk-1"])
+
+    def test_no_state_file(self):
+        self.assertEqual(dcs.dcs_load_samples(self.target), {})
+        with open(self.target["rates_state_file"], "w") as f:
+            f.write("{truncated")
+        self.assertEqual(dcs.dcs_load_samples(self.target), {})
+
+
+class JsonEncoderTest(unittest.TestCase):
+
+    def records(self):
+        """
+        Records of two objects from the metadata cache, the way an emitter
+        builds them
+        """
+        records = []
+        for dcs_id, caption in (("vdisk-1", 'Disk "quoted" \\ back\\slash'), ("vdisk-2", "Dísk\ttab")):
+            meta = {"instance": caption, "objecttype": "DataCore Virtual disks", "id": dcs_id, "Size": None}
+            cached = {"meta": meta, "size": len(meta), "prefixes": {}}
+            collection_time = "/Date({})/".format(1700000000000 + len(records))
+            records.append(dcs.dcs_record(meta, "TotalReads", 123456789012, collection_time, cached))
+            records.append(dcs.dcs_record(meta, "Latency", 0.25, collection_time, cached))
+            records.append(dcs.dcs_record(meta, "Caption", caption, collection_time, cached))
+            record = dcs.dcs_record(meta, "TotalWrites", 7, collection_time, cached)
+            record["Delta"], record["Rate"] = 3, 0.05
+            records.append(record)
+            # Overwriting a metadata key
+            records.append(dcs.dcs_record(meta, "Size", 1024, collection_time, cached))
+        return records
+
+    def test_prefix_encoder_matches_json(self):
+        encode = dcs.dcs_json_encoder("json")
+        for record in self.records():
+            expected = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+            self.assertEqual(encode(record), expected)
+            # Again, from the serialized metadata
+            self.assertEqual(encode(record), expected)
+
+    def test_valid_json_numeric_counters(self):
+        for name in ("auto", "json"):
+            encode = dcs.dcs_json_encoder(name)
+            for record in self.records():
+                decoded = json.loads(encode(record).decode("utf-8"))
+                self.assertEqual(decoded, dict(record))
+                for key in ("TotalReads", "Latency", "TotalWrites", "Delta", "Rate"):
+                    if key in decoded:
+                        self.assertIsInstance(decoded[key], (int, float))
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        config = dcs.configparser.ConfigParser()
+        config.read_dict({"PERF": {"adaptive": "yes", "min_workers": "2", "latency_tolerance": "2"}})
+        settings = dcs.dcs_settings(config)
+        self.target = {"settings": settings, "concurrency": dcs.dcs_new_concurrency(settings, 16),
+                       "stats": dcs.dcs_new_stats()}
+
+    def observe(self, count=1, latency=0.01, retries=0, error=None, batch=False):
+        for _ in range(count):
+            dcs.dcs_observe_concurrency(self.target, "virtualdisks", (latency, 200, 0, retries, error), batch)
+        return self.target["concurrency"]["limit"]
+
+    def test_slow_start(self):
+        self.assertEqual(dcs.dcs_concurrency_limit(self.target), 2)
+        self.assertEqual(self.observe(5), 7)
+        # Up to max_workers
+        self.assertEqual(self.observe(20), 16)
+
+    def test_one_cut_per_window(self):
+        self.observe(6)
+        # No cut before a window of limit calls passed
+        self.assertEqual(self.observe(error="Timeout"), 8)
+        self.assertEqual(self.observe(error="Timeout"), 6)
+        self.assertEqual(self.target["stats"]["backoffs"], 1)
+        self.assertFalse(self.target["concurrency"]["slow_start"])
+        # The requests in flight fail too, no cut before the window passed
+        self.assertEqual(self.observe(5, retries=1), 6)
+        self.assertEqual(self.observe(retries=1), 4.5)
+        self.assertEqual(self.target["stats"]["backoffs"], 2)
+
+    def test_additive_increase(self):
+        self.observe(6)
+        self.assertEqual(self.observe(2, error="Timeout"), 6)
+        # About one more per window
+        self.assertAlmostEqual(self.observe(6), 7, delta=0.1)
+
+    def test_floor(self):
+        self.observe(10)
+        for _ in range(20):
+            self.observe(16, error="Timeout")
+        self.assertEqual(self.target["concurrency"]["limit"], 2)
+        self.assertEqual(dcs.dcs_concurrency_limit(self.target), 2)
+
+    def test_latency_warmup(self):
+        self.observe()
+        # Slow calls before the latency is trusted
+        self.observe(dcs.DCS_LATENCY_WARMUP - 2, latency=0.1)
+        self.assertEqual(self.target["stats"]["backoffs"], 0)
+        self.observe(20, latency=0.1)
+        self.assertGreater(self.target["stats"]["backoffs"], 0)
+
+    def test_latency_drift(self):
+        self.observe(dcs.DCS_LATENCY_WARMUP)
+        self.observe(2000, latency=0.05)
+        # The baseline followed the lasting slowdown
+        backoffs = self.target["stats"]["backoffs"]
+        self.assertGreater(backoffs, 0)
+        limit = self.target["concurrency"]["limit"]
+        self.assertGreaterEqual(self.observe(50, latency=0.05), limit)
+        self.assertEqual(self.target["stats"]["backoffs"], backoffs)
+
+    def test_batch_latency_ignored(self):
+        self.observe(dcs.DCS_LATENCY_WARMUP)
+        self.observe(20, latency=1.0, batch=True)
+        self.assertEqual(self.target["stats"]["backoffs"], 0)
+        self.observe(12, error="HTTP 503", batch=True)
+        self.assertEqual(self.target["stats"]["backoffs"], 1)
+
+    def test_not_adaptive(self):
+        self.target["concurrency"] = None
+        dcs.dcs_observe_concurrency(self.target, "virtualdisks", (0.01, 0, 0, 0, "Timeout"))
+        self.assertIsNone(dcs.dcs_concurrency_limit(self.target))
+
+
+class FilterTest(unittest.TestCase):
+
+    def filters(self, **options):
+        config = dcs.configparser.ConfigParser()
+        config.read_dict({"FILTERS": options})
+        specs = dcs.dcs_load_resource_specs(config)
+        rules = dcs.dcs_load_filter_rules(config, specs)
+        objects = dict((name, dcs.dcs_make_object_filter(spec, name, rules)) for name, spec in specs.items())
+        counters = dict((name, dcs.dcs_make_counter_filter(name, rules)) for name in specs)
+        return objects, counters
+
+    def disk(self, dcs_id, caption, profile="profile-1"):
+        return {"Id": dcs_id, "Caption": caption, "ExtendedCaption": caption + " on SDS1", "StorageProfileId": profile}
+
+    def test_no_rules(self):
+        objects, counters = self.filters()
+        self.assertTrue(objects["ports"]({"Id": "port-1", "Caption": "Port 1"}))
+        self.assertIsNone(counters["virtualdisks"])
+        # The spec filter still applies
+        self.assertTrue(objects["virtualdisks"](self.disk("vdisk-1", "SQL1")))
+        self.assertFalse(objects["virtualdisks"](self.disk("vdisk-1", "SQL1", profile=None)))
+
+    def test_resource_prefix(self):
+        objects, _ = self.filters(include_captions="virtualdisks:SQL*, Pool*")
+        accept = objects["virtualdisks"]
+        self.assertTrue(accept(self.disk("vdisk-1", "SQL1")))
+        self.assertTrue(accept(self.disk("vdisk-2", "Pool disk")))
+        self.assertFalse(accept(self.disk("vdisk-3", "Exchange")))
+        # Not limited to virtual disks
+        self.assertTrue(objects["pools"]({"Id": "pool-1", "Caption": "Pool 1"}))
+        self.assertFalse(objects["pools"]({"Id": "pool-2", "Caption": "SQL pool"}))
+        # ExtendedCaption matches too
+        self.assertFalse(accept(self.disk("vdisk-4", "Other")))
+        objects, _ = self.filters(include_captions="*on SDS1")
+        self.assertTrue(objects["virtualdisks"](self.disk("vdisk-4", "Other")))
+
+    def test_ids_with_colon(self):
+        dcs_id = "0d2d3e2a-1b4c:virtualdisks:42"
+        objects, _ = self.filters(exclude_ids="{}, pools:pool-1".format(dcs_id))
+        self.assertFalse(objects["virtualdisks"](self.disk(dcs_id, "SQL1")))
+        self.assertTrue(objects["virtualdisks"](self.disk("vdisk-2", "SQL2")))
+        self.assertFalse(objects["pools"]({"Id": "pool-1", "Caption": "Pool 1"}))
+        self.assertTrue(objects["servers"]({"Id": "pool-1", "Caption": "Pool 1"}))
+
+    def test_exclude_wins(self):
+        objects, _ = self.filters(include_captions="SQL*", include_ids="vdisk-9", exclude_captions="*test*",
+                                  exclude_ids="vdisk-1")
+        accept = objects["virtualdisks"]
+        self.assertFalse(accept(self.disk("vdisk-1", "SQL1")))
+        self.assertFalse(accept(self.disk("vdisk-2", "SQL test")))
+        self.assertFalse(accept(self.disk("vdisk-9", "test")))
+        self.assertTrue(accept(self.disk("vdisk-9", "Exchange")))
+        self.assertTrue(accept(self.disk("vdisk-3", "SQL3")))
+
+    def test_counters(self):
+        _, counters = self.filters(include_counters="TotalReads, virtualdisks:Total*Time",
+                                   exclude_counters="*Write*")
+        accept = counters["virtualdisks"]
+        self.assertTrue(accept("TotalReads"))
+        self.assertTrue(accept("TotalReadTime"))
+        self.assertFalse(accept("TotalWriteTime"))
+        self.assertFalse(accept("TotalBytesRead"))
+        self.assertTrue(counters["pools"]("TotalReads"))
+        self.assertFalse(counters["pools"]("TotalReadTime"))
+        # Cached answers stay the same
+        self.assertFalse(accept("TotalWriteTime"))
+
+
+class SinkTest(unittest.TestCase):
+
+    meta = {"instance": "Disk 1,a=b", "objecttype": "DataCore Virtual disks", "id": "vdisk-1", "host": ""}
+    collection_time = "/Date(1700000000000)/"
+
+    def record(self, key, value, meta=None, delta=None):
+        record = dcs.dcs_record(meta or self.meta, key, value, self.collection_time)
+        if delta is not None:
+            record["Delta"], record["Rate"] = delta
+        return record
+
+    def test_influx_escaping(self):
+        prefix = rb"DataCore\ Virtual\ disks,instance=Disk\ 1\,a\=b,id=vdisk-1 "
+        self.assertEqual(dcs.dcs_influx_line(self.record("TotalReads", 5, delta=(2, 0.5))),
+                         prefix + b"TotalReads=5i,TotalReads_delta=2i,TotalReads_rate=0.5 1700000000000000000\n")
+        self.assertEqual(dcs.dcs_influx_line(self.record("Caption", 'a "b" \\c')),
+                         prefix + rb'Caption="a \"b\" \\c" 1700000000000000000' + b"\n")
+        self.assertEqual(dcs.dcs_influx_line(self.record("Healthy", True)),
+                         prefix + b"Healthy=true 1700000000000000000\n")
+        self.assertEqual(dcs.dcs_influx_line(self.record("Size", None)), b"")
+
+    def test_graphite_escaping(self):
+        encode = dcs.dcs_graphite_encoder("datacore")
+        meta = dict(self.meta, instance="Disk 1/a.b", target="group 1")
+        path = b"datacore.group_1.DataCore_Virtual_disks.Disk_1_a_b."
+        self.assertEqual(encode(self.record("TotalReads", 5, meta, delta=(2, 0.5))),
+                         path + b"TotalReads 5 1700000000\n" + path + b"TotalReads_delta 2 1700000000\n"
+                         + path + b"TotalReads_rate 0.5 1700000000\n")
+        # Only numeric values
+        self.assertEqual(encode(self.record("Caption", "Disk 1", meta)), b"")
+
+    def test_send_batches(self):
+        encode = lambda record: record
+        sent = []
+        stats = dcs.dcs_new_cycle()["write"]
+        dcs._dcs_send_records([b"a\n", b"", b"bb\n", b"c\n", b"dddd\n"], encode, stats, sent.append, max_lines=2)
+        self.assertEqual(sent, [b"a\nbb\n", b"c\ndddd\n"])
+        self.assertEqual((stats["records"], stats["bytes"], stats["errors"]), (5, 12, 0))
+
+        sent = []
+        dcs._dcs_send_records([b"a\n", b"bb\n", b"c\n", b"dddd\n"], encode, None, sent.append, max_bytes=5)
+        self.assertEqual(sent, [b"a\nbb\n", b"c\n", b"dddd\n"])
+
+    def test_send_failure_counted(self):
+        def send(data):
+            if data.startswith(b"a"):
+                raise OSError("Connection refused")
+            sent.append(data)
+        sent = []
+        stats = dcs.dcs_new_cycle()["write"]
+        dcs._dcs_send_records([b"a\n", b"b\n", b"c\n"], lambda record: record, stats, send, max_lines=1)
+        self.assertEqual(sent, [b"b\n", b"c\n"])
+        self.assertEqual(stats["errors"], 1)
+
+    def test_rotating_sink(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        write = dcs.dcs_rotating_sink(os.path.join(workdir, "perf.json"), lambda record: record, None, 4, 2)
+
+        def names():
+            return sorted(os.listdir(workdir))
+
+        for n in range(4):
+            write([b"%d\n" % n] * 2, dcs.dcs_new_cycle()["write"])
+            # Distinct modification times, oldest first
+            for name in names():
+                path = os.path.join(workdir, name)
+                os.utime(path, (os.path.getmtime(path) - 10, os.path.getmtime(path) - 10))
+        # Rotated numbers go on after the removed ones
+        self.assertEqual(names(), ["perf.3.json", "perf.json"])
+        with open(os.path.join(workdir, "perf.3.json"), "rb") as f:
+            self.assertEqual(f.read(), b"2\n2\n")
+        with open(os.path.join(workdir, "perf.json"), "rb") as f:
+            self.assertEqual(f.read(), b"3\n3\n")
+
+        # Appended to while under the size
+        write = dcs.dcs_rotating_sink(os.path.join(workdir, "small.json"), lambda record: record, None, 100, 0)
+        write([b"a\n"], dcs.dcs_new_cycle()["write"])
+        write([b"b\n"], dcs.dcs_new_cycle()["write"])
+        with open(os.path.join(workdir, "small.json"), "rb") as f:
+            self.assertEqual(f.read(), b"a\nb\n")
+
+
+class RunTest(unittest.TestCase):
+
+    def start(self):
+        server = mock.serve_in_thread(port=0, **SCALE)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        collector = make_collector(server.server_address[1], output={"file": os.path.join(directory, "perf.json")})
+        collector.settings["daemon_interval"] = 0.2
+        self.addCleanup(collector.close)
+        return collector
+
+    def test_signal_handlers_restored(self):
+        collector = self.start()
+        previous = dict((s, signal.getsignal(s)) for s in (signal.SIGINT, signal.SIGTERM))
+        threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        collector.run()
+        for signum, handler in previous.items():
+            self.assertIs(signal.getsignal(signum), handler)
+
+    def test_caller_stop_event(self):
+        collector = self.start()
+        previous = signal.getsignal(signal.SIGTERM)
+        stop = threading.Event()
+        thread = threading.Thread(target=collector.run, kwargs={"stop": stop})
+        thread.start()
+        stop.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIs(signal.getsignal(signal.SIGTERM), previous)
+
+
+class ShardingTest(unittest.TestCase):
+
+    def settings(self, **sharding):
+        config = dcs.configparser.ConfigParser()
+        config.read_dict({
+            "OUTPUT": {"file": "perf.json"},
+            "STATS": {"file": "stats.json"},
+            "SHARDING": sharding,
+        })
+        return dcs.dcs_settings(config)
+
+    def test_files_get_shard_suffix(self):
+        settings = self.settings(count="3", index="1")
+        self.assertEqual(settings["output_file"], "perf_shard1.json")
+        self.assertEqual(settings["stats_file"], "stats_shard1.json")
+
+    def test_single_shard_files_unchanged(self):
+        settings = self.settings()
+        self.assertEqual(settings["output_file"], "perf.json")
+        self.assertEqual(settings["stats_file"], "stats.json")
+
+
+if __name__ == "__main__":
+    unittest.main()